@@ -4,103 +4,143 @@ App 1: Story Generator
 Generates narrated story scripts using Qwen 3 4B via Ollama.
 """
 
-import json
 import random
+import functools
+import threading
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import sys
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
 # Add parent to path for shared imports
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 import requests
-from shared.config import OLLAMA_MODEL, OLLAMA_BASE_URL, OUTPUT_DIR, SCENES_COUNT, TARGET_DURATION
+from shared.config import (
+    OLLAMA_MODEL, OLLAMA_BASE_URL, OLLAMA_MAX_INFLIGHT,
+    OUTPUT_DIR, SCENES_COUNT, TARGET_DURATION
+)
 from shared.models import Story, Scene
+from shared.json_utils import dumps, loads, parse_llm_json, write_json_atomic
+from shared.http import get_session
 
 # Default model is now gemma3:27b-abliterated
 
+# Ollama serializes generation on the GPU; more requests in flight only queue up and time out
+_ollama_slots = threading.BoundedSemaphore(OLLAMA_MAX_INFLIGHT)
+
+_OLLAMA_OPTIONS = {
+    "temperature": 0.8,
+    "top_p": 0.9,
+    "num_predict": 2000
+}
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+@functools.lru_cache(maxsize=None)
+def _read_prompt(path: str) -> str:
+    """Read a prompt file (cached, files don't change at runtime)"""
+    return Path(path).read_text(encoding="utf-8")
+
+
+@functools.lru_cache(maxsize=None)
+def _read_topics(path: str) -> dict:
+    """Read and parse the topics file (cached, treat result as read-only)"""
+    return loads(Path(path).read_bytes())
+
 
 class StoryGenerator:
     """Generate stories using local LLM via Ollama"""
     
-    def __init__(self, model: str = OLLAMA_MODEL, base_url: str = OLLAMA_BASE_URL):
+    def __init__(
+        self,
+        model: str = OLLAMA_MODEL,
+        base_url: str = OLLAMA_BASE_URL,
+        session: Optional[requests.Session] = None
+    ):
         self.model = model
         self.base_url = base_url
         self.prompts_dir = Path(__file__).parent / "prompts"
         self.topics_file = Path(__file__).parent / "topics.json"
         
+        # Share one keep-alive connection pool across clients unless given a session
+        self.session = session or get_session()
+        
     def _load_system_prompt(self) -> str:
         """Load the story generation system prompt"""
-        prompt_path = self.prompts_dir / "story_system.txt"
-        return prompt_path.read_text()
+        return _read_prompt(str(self.prompts_dir / "story_system.txt"))
     
     def _load_topics(self) -> dict:
         """Load topics from JSON file"""
-        return json.loads(self.topics_file.read_text())
+        return _read_topics(str(self.topics_file))
+    
+    @functools.cached_property
+    def _topics_by_cat(self) -> dict:
+        """Topic categories indexed by lowercased name"""
+        return {cat["category"].lower(): cat for cat in self._load_topics()["topics"]}
     
     def _get_random_topic(self, category: Optional[str] = None) -> tuple[str, str]:
         """Get a random topic, optionally from a specific category"""
-        topics_data = self._load_topics()
-        
         if category:
-            # Find specific category
-            for cat in topics_data["topics"]:
-                if cat["category"].lower() == category.lower():
-                    prompt = random.choice(cat["prompts"])
-                    return category, prompt
-            raise ValueError(f"Category '{category}' not found")
+            cat = self._topics_by_cat.get(category.lower())
+            if cat is None:
+                raise ValueError(f"Category '{category}' not found")
+            return category, random.choice(cat["prompts"])
         else:
             # Random category and prompt
-            cat = random.choice(topics_data["topics"])
-            prompt = random.choice(cat["prompts"])
-            return cat["category"], prompt
+            cat = random.choice(self._load_topics()["topics"])
+            return cat["category"], random.choice(cat["prompts"])
     
     def _call_ollama(self, system_prompt: str, user_prompt: str) -> str:
         """Call Ollama API with the given prompts"""
         url = f"{self.base_url}/api/generate"
         
-        payload = {
+        # Serialize once up front instead of letting requests run stdlib json
+        body = dumps({
             "model": self.model,
             "prompt": user_prompt,
             "system": system_prompt,
-            "stream": False,
-            "options": {
-                "temperature": 0.8,
-                "top_p": 0.9,
-                "num_predict": 2000
-            }
-        }
+            "stream": True,
+            "options": _OLLAMA_OPTIONS
+        })
         
         print(f"🤖 Calling Ollama ({self.model})...")
         
-        try:
-            response = requests.post(url, json=payload, timeout=120)
-            response.raise_for_status()
-            result = response.json()
-            return result.get("response", "")
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError(
-                f"Cannot connect to Ollama at {self.base_url}. "
-                "Make sure Ollama is running: 'ollama serve'"
-            )
-        except requests.exceptions.Timeout:
-            raise TimeoutError("Ollama request timed out. Try a smaller model or increase timeout.")
+        with _ollama_slots:
+            try:
+                # Fail fast if Ollama is down, but allow the full generation time
+                response = self.session.post(
+                    url, data=body, headers=_JSON_HEADERS, timeout=(10, 120), stream=True
+                )
+                response.raise_for_status()
+            
+                # Each streamed line is a JSON object carrying the next piece of the response
+                chunks = []
+                with response:
+                    for line in response.iter_lines():
+                        if not line:
+                            continue
+                        chunk = loads(line)
+                        if "error" in chunk:
+                            raise RuntimeError(f"Ollama error: {chunk['error']}")
+                        chunks.append(chunk.get("response", ""))
+                        if chunk.get("done"):
+                            break
+                return "".join(chunks)
+            except requests.exceptions.ConnectionError:
+                raise ConnectionError(
+                    f"Cannot connect to Ollama at {self.base_url}. "
+                    "Make sure Ollama is running: 'ollama serve'"
+                )
+            except requests.exceptions.Timeout:
+                raise TimeoutError("Ollama request timed out. Try a smaller model or increase timeout.")
     
     def _parse_story_json(self, raw_response: str) -> Story:
         """Parse LLM response into Story model"""
-        # Clean up response - remove markdown code blocks if present
-        cleaned = raw_response.strip()
-        if cleaned.startswith("```"):
-            # Remove code block markers
-            lines = cleaned.split("\n")
-            lines = [l for l in lines if not l.startswith("```")]
-            cleaned = "\n".join(lines)
-        
-        # Parse JSON
         try:
-            data = json.loads(cleaned)
-        except json.JSONDecodeError as e:
+            data = parse_llm_json(raw_response)
+        except ValueError as e:
             print(f"⚠️ JSON parse error: {e}")
             print(f"Raw response:\n{raw_response[:500]}...")
             raise ValueError("Failed to parse story JSON from LLM response")
@@ -146,6 +186,33 @@ Return ONLY valid JSON, no other text."""
         
         return story
     
+    def generate_batch(
+        self,
+        topics: List[str],
+        category: Optional[str] = None,
+        max_workers: int = OLLAMA_MAX_INFLIGHT
+    ) -> List[Optional[Story]]:
+        """
+        Generate one story per topic, overlapping the Ollama requests.
+        
+        Args:
+            topics: Story premises, one per story
+            category: Category label applied to every story
+            max_workers: Number of requests in flight at once
+            
+        Returns:
+            Stories in input order (None where generation failed)
+        """
+        def generate_one(topic: str) -> Optional[Story]:
+            try:
+                return self.generate(category=category, topic_override=topic)
+            except Exception as e:
+                print(f"❌ Failed '{topic[:40]}': {e}")
+                return None
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(generate_one, topics))
+    
     def save_story(self, story: Story, output_path: Optional[Path] = None) -> Path:
         """Save story to JSON file"""
         if output_path is None:
@@ -155,7 +222,7 @@ Return ONLY valid JSON, no other text."""
             output_path = OUTPUT_DIR / f"story_{timestamp}.json"
         
         output_path.parent.mkdir(parents=True, exist_ok=True)
-        output_path.write_text(story.model_dump_json(indent=2))
+        write_json_atomic(output_path, story.model_dump(mode="json"))
         
         print(f"💾 Saved to: {output_path}")
         return output_path
@@ -167,12 +234,16 @@ def main():
     parser.add_argument("--topic", "-t", type=str, help="Custom topic/premise override")
     parser.add_argument("--output", "-o", type=str, help="Output JSON file path")
     parser.add_argument("--model", "-m", type=str, default=OLLAMA_MODEL, help=f"Ollama model (default: {OLLAMA_MODEL})")
+    parser.add_argument("--batch", "-b", type=str, help="Text file with one topic per line (--output is then a directory)")
     
     args = parser.parse_args()
     
     # Initialize generator
     generator = StoryGenerator(model=args.model)
     
+    if args.batch:
+        return run_batch(generator, Path(args.batch), args.category, args.output)
+    
     # Generate story
     try:
         story = generator.generate(
@@ -202,5 +273,30 @@ def main():
         sys.exit(1)
 
 
+def run_batch(generator: StoryGenerator, topics_path: Path, category: Optional[str], output: Optional[str]) -> List[str]:
+    """Generate and save one story per line of a topics file"""
+    topics = [line.strip() for line in topics_path.read_text().splitlines() if line.strip()]
+    if not topics:
+        print(f"❌ No topics found in {topics_path}")
+        sys.exit(1)
+    
+    import datetime
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    output_dir = Path(output) if output else OUTPUT_DIR
+    
+    stories = generator.generate_batch(topics, category=category)
+    
+    saved = []
+    for i, story in enumerate(stories):
+        if story is not None:
+            path = generator.save_story(story, output_dir / f"story_{timestamp}_{i:03d}.json")
+            saved.append(str(path))
+    
+    print(f"\n📋 Generated {len(saved)}/{len(topics)} stories")
+    if not saved:
+        sys.exit(1)
+    return saved
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,37 @@
+"""
+CUDA helpers shared by the visual services.
+"""
+
+import gc
+
+
+def release_cuda_memory(name: str):
+    """
+    Return a just-unloaded model's memory to the driver and log its peak.
+    
+    gc.collect() first drops reference cycles still holding tensors, so
+    empty_cache() can actually free their blocks. Resetting the peak stats
+    makes each model's reported peak its own.
+    """
+    import torch
+    
+    gc.collect()
+    
+    if not torch.cuda.is_available():
+        print(f"🧹 {name} unloaded")
+        return
+    
+    peak_gb = torch.cuda.max_memory_allocated() / 1024 ** 3
+    torch.cuda.empty_cache()
+    torch.cuda.ipc_collect()
+    torch.cuda.reset_peak_memory_stats()
+    print(f"🧹 {name} unloaded (peak VRAM {peak_gb:.1f} GB)")
+
+
+def enable_fast_matmul():
+    """Allow TF32 matmul/conv and cuDNN autotuning (idempotent, call before inference)"""
+    import torch
+    
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True  # Shapes are fixed per story, so autotuning pays off
@@ -4,28 +4,43 @@ Character consistency using Qwen-Image-Edit model.
 https://github.com/QwenLM/Qwen-Image
 """
 
-import torch
 from pathlib import Path
 from typing import Optional
-import sys
 
-sys.path.insert(0, str(Path(__file__).parent.parent.parent))
-from shared.config import QWEN_IMAGE_EDIT_MODEL, TORCH_DTYPE, LOW_VRAM_MODE
+from shared.config import QWEN_IMAGE_EDIT_MODEL, QWEN_QUANT, TORCH_DTYPE, LOW_VRAM_MODE
+from .cuda_memory import enable_fast_matmul, release_cuda_memory
+
+
+def _as_image(image):
+    """Return an RGB PIL image from a PIL image or a path to one"""
+    from PIL import Image
+    
+    if isinstance(image, Image.Image):
+        return image if image.mode == "RGB" else image.convert("RGB")
+    with Image.open(image) as img:
+        return img.convert("RGB")
 
 
 class QwenImageEditService:
     """Apply character consistency using local Qwen-Image-Edit model"""
     
-    def __init__(self, model_id: str = QWEN_IMAGE_EDIT_MODEL):
+    def __init__(self, model_id: str = QWEN_IMAGE_EDIT_MODEL, quant: str = QWEN_QUANT):
         """
         Initialize Qwen-Image-Edit service.
         
         Args:
             model_id: HuggingFace model ID or local path
+            quant: Weight quantization: 'nf4', 'int8', or 'none'
         """
         self.model_id = model_id
+        self.quant = quant
         self.pipe = None
+        self.model = None
+        self.processor = None
         self._loaded = False
+        
+        # Decoded reference image keyed by (path, mtime); the same reference is used for every scene
+        self._ref_cache: dict[tuple[str, float], object] = {}
     
     def load_model(self):
         """Load the Qwen-Image-Edit pipeline"""
@@ -38,24 +53,27 @@ class QwenImageEditService:
         try:
             # Qwen-Image-Edit uses a custom pipeline
             # Note: This may require specific installation from Qwen-Image repo
+            import torch
             from transformers import AutoProcessor, AutoModel
-            from PIL import Image
+            
+            enable_fast_matmul()
             
             self.processor = AutoProcessor.from_pretrained(
                 self.model_id,
                 trust_remote_code=True
             )
             
+            quantization_config = self._quantization_config()
+            
             self.model = AutoModel.from_pretrained(
                 self.model_id,
                 torch_dtype=getattr(torch, TORCH_DTYPE),
                 trust_remote_code=True,
-                device_map="auto" if LOW_VRAM_MODE else None
+                quantization_config=quantization_config,
+                low_cpu_mem_usage=True,  # Materialize weights on the target device, no CPU copy
+                **self._placement(quantization_config)
             )
             
-            if not LOW_VRAM_MODE:
-                self.model = self.model.cuda()
-            
             self._loaded = True
             print("✅ Qwen-Image-Edit loaded")
             
@@ -64,6 +82,93 @@ class QwenImageEditService:
             print("   Character consistency will be skipped.")
             self._loaded = False
     
+    def _quantization_config(self):
+        """Build the bitsandbytes config for self.quant (None for full precision)"""
+        if self.quant in ("", "none"):
+            return None
+        
+        import torch
+        
+        try:
+            import bitsandbytes  # noqa: F401
+            from transformers import BitsAndBytesConfig
+        except ImportError:
+            print(f"⚠️ bitsandbytes not installed, loading without {self.quant} quantization")
+            return None
+        
+        if self.quant == "nf4":
+            print("   Quantizing weights to NF4...")
+            return BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=getattr(torch, TORCH_DTYPE)
+            )
+        if self.quant == "int8":
+            print("   Quantizing weights to INT8...")
+            return BitsAndBytesConfig(load_in_8bit=True)
+        
+        print(f"⚠️ Unknown quantization '{self.quant}', loading full precision")
+        return None
+    
+    def _placement(self, quantization_config) -> dict:
+        """
+        Pick weight placement (device_map/max_memory kwargs) for from_pretrained.
+        
+        device_map="auto" splits layers across devices and runs them one
+        after another, which is never faster than a single GPU. It is only
+        used as a last resort: low-VRAM mode with one GPU and no
+        quantization, where it spills layers to CPU (slow, but a
+        full-precision model won't fit otherwise).
+        """
+        # Quantized weights, or any weights outside low-VRAM mode, go straight to GPU 0
+        if quantization_config is not None or not LOW_VRAM_MODE:
+            return {"device_map": {"": 0}}
+        
+        import torch
+        
+        if torch.cuda.device_count() > 1:
+            # Spread across GPUs by free memory, keeping headroom for activations
+            max_memory = {
+                i: int(torch.cuda.mem_get_info(i)[0] * 0.9)
+                for i in range(torch.cuda.device_count())
+            }
+            return {"device_map": "balanced", "max_memory": max_memory}
+        
+        print("⚠️ No quantization on a single GPU: offloading layers to CPU (slow)")
+        return {"device_map": "auto"}
+    
+    def _to_model_device(self, inputs) -> dict:
+        """Move processor outputs to the device the model runs on"""
+        # A map spanning several devices has accelerate hooks that move inputs themselves;
+        # a single-device map ({"": 0}) has none, so inputs must already be on that GPU
+        device_map = getattr(self.model, "hf_device_map", None)
+        if device_map and len(set(device_map.values())) > 1:
+            return dict(inputs)
+        device = self.model.device
+        return {k: v.to(device) if hasattr(v, "to") else v for k, v in inputs.items()}
+    
+    def _load_reference(self, reference_image_path):
+        """Open the reference image once per (path, mtime) and reuse the decoded RGB copy"""
+        if not isinstance(reference_image_path, (str, Path)):
+            return _as_image(reference_image_path)  # Already decoded
+        
+        reference_image_path = Path(reference_image_path)
+        key = (str(reference_image_path), reference_image_path.stat().st_mtime)
+        if key not in self._ref_cache:
+            self._ref_cache.clear()
+            self._ref_cache[key] = _as_image(reference_image_path)
+        return self._ref_cache[key]
+    
+    @staticmethod
+    def _edit_prompt(prompt: str, character_description: str) -> str:
+        """Build edit prompt for consistency"""
+        return (
+            f"Edit this image to match the character from the reference image. "
+            f"Character: {character_description}. "
+            f"Scene: {prompt}. "
+            f"Keep the same face, clothing, and appearance as the reference."
+        )
+    
     def apply_consistency(
         self,
         source_image_path: Path,
@@ -75,8 +180,8 @@ class QwenImageEditService:
         Apply character from reference to source image.
         
         Args:
-            source_image_path: New scene image
-            reference_image_path: Reference character image
+            source_image_path: New scene image (path or PIL.Image)
+            reference_image_path: Reference character image (path or PIL.Image)
             prompt: Scene description
             character_description: Character details for this scene
             
@@ -86,26 +191,20 @@ class QwenImageEditService:
         if not self._loaded:
             self.load_model()
         
+        source_img = _as_image(source_image_path)
+        
         if not self._loaded:
             # Model failed to load, return source as-is
-            from PIL import Image
-            return Image.open(source_image_path)
-        
-        from PIL import Image
+            return source_img
         
-        source_img = Image.open(source_image_path)
-        reference_img = Image.open(reference_image_path)
+        reference_img = self._load_reference(reference_image_path)
         
-        # Build edit prompt for consistency
-        edit_prompt = (
-            f"Edit this image to match the character from the reference image. "
-            f"Character: {character_description}. "
-            f"Scene: {prompt}. "
-            f"Keep the same face, clothing, and appearance as the reference."
-        )
+        edit_prompt = self._edit_prompt(prompt, character_description)
         
         print(f"🔄 Applying character consistency...")
         
+        import torch
+        
         try:
             # Process inputs
             inputs = self.processor(
@@ -114,11 +213,10 @@ class QwenImageEditService:
                 return_tensors="pt"
             )
             
-            if torch.cuda.is_available() and not LOW_VRAM_MODE:
-                inputs = {k: v.cuda() for k, v in inputs.items()}
+            inputs = self._to_model_device(inputs)
             
             # Generate
-            with torch.no_grad():
+            with torch.inference_mode():
                 outputs = self.model.generate(**inputs)
             
             # Decode output image
@@ -155,6 +253,74 @@ class QwenImageEditService:
         print(f"💾 Saved to: {output_path}")
         return output_path
     
+    def apply_consistency_batch(
+        self,
+        source_image_paths: list[Path],
+        reference_image_path: Path,
+        prompts: list[str],
+        character_descriptions: list[str]
+    ) -> list:
+        """
+        Apply character from reference to several source images in one forward pass.
+        
+        Args:
+            source_image_paths: New scene images (paths or PIL.Images)
+            reference_image_path: Reference character image, path or PIL.Image (shared by all)
+            prompts: Scene description per image
+            character_descriptions: Character details per image
+            
+        Returns:
+            List of PIL.Image with consistent character, in input order
+        """
+        if not self._loaded:
+            self.load_model()
+        
+        if not self._loaded:
+            # Model failed to load, return sources as-is
+            return [_as_image(path) for path in source_image_paths]
+        
+        if len(source_image_paths) == 1:
+            return [self.apply_consistency(
+                source_image_paths[0], reference_image_path, prompts[0], character_descriptions[0]
+            )]
+        
+        source_imgs = [_as_image(path) for path in source_image_paths]
+        reference_img = self._load_reference(reference_image_path)
+        edit_prompts = [
+            self._edit_prompt(prompt, description)
+            for prompt, description in zip(prompts, character_descriptions)
+        ]
+        
+        print(f"🔄 Applying character consistency to {len(source_imgs)} images...")
+        
+        import torch
+        
+        try:
+            inputs = self.processor(
+                text=edit_prompts,
+                images=[[source_img, reference_img] for source_img in source_imgs],
+                padding=True,
+                return_tensors="pt"
+            )
+            
+            inputs = self._to_model_device(inputs)
+            
+            with torch.inference_mode():
+                outputs = self.model.generate(**inputs)
+            
+            result_images = self.processor.batch_decode(outputs)
+            
+            print("✅ Character consistency applied")
+            return list(result_images)
+            
+        except Exception as e:
+            # Batched input isn't supported by every processor revision; edit one at a time
+            print(f"⚠️ Batched edit failed ({e}), editing images one at a time")
+            return [
+                self.apply_consistency(path, reference_image_path, prompt, description)
+                for path, prompt, description in zip(source_image_paths, prompts, character_descriptions)
+            ]
+    
     def unload_model(self):
         """Unload model to free memory"""
         if self.model is not None:
@@ -164,10 +330,7 @@ class QwenImageEditService:
             self.processor = None
             self._loaded = False
             
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            
-            print("🧹 Qwen-Image-Edit unloaded")
+            release_cuda_memory("Qwen-Image-Edit")
 
 
 class SimpleConsistencyService:
@@ -182,6 +345,9 @@ class SimpleConsistencyService:
     def load_model(self):
         pass
     
+    def unload_model(self):
+        pass
+    
     def apply_consistency(
         self,
         source_image_path: Path,
@@ -190,9 +356,19 @@ class SimpleConsistencyService:
         character_description: str
     ):
         """Simple fallback - returns source image as-is"""
-        from PIL import Image
         print("⚠️ Using fallback consistency (no editing)")
-        return Image.open(source_image_path)
+        return _as_image(source_image_path)
+    
+    def apply_consistency_batch(
+        self,
+        source_image_paths: list,
+        reference_image_path,
+        prompts: list[str],
+        character_descriptions: list[str]
+    ) -> list:
+        """Simple fallback - returns source images as-is"""
+        print("⚠️ Using fallback consistency (no editing)")
+        return [_as_image(path) for path in source_image_paths]
     
     def apply_to_file(
         self,
@@ -6,21 +6,70 @@ https://github.com/Wan-Video/Wan2.2
 
 import subprocess
 import os
+import json
+import threading
+from collections import deque
 from pathlib import Path
 from typing import Optional
 import sys
 import shutil
 
-sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 from shared.config import (
     WAN_REPO_PATH, WAN_MODEL_PATH, WAN_VIDEO_SIZE, 
     WAN_T5_CPU, WAN_OFFLOAD_MODEL, VIDEO_FPS
 )
 
+WORKER_SCRIPT = Path(__file__).parent / "wan_worker.py"
+GENERATION_TIMEOUT = 1800  # 30 minutes per clip
+
+
+def _run_streaming(cmd: list, cwd: Path, timeout: float, tail_lines: int = 200) -> tuple[Optional[int], deque]:
+    """
+    Run a command, reading its combined output line by line as it is produced.
+    
+    Only the last tail_lines lines are kept, so a long run with progress
+    bars doesn't accumulate its whole log in memory.
+    
+    Returns:
+        (returncode, tail); returncode is None if the process was killed at the deadline
+    """
+    proc = subprocess.Popen(
+        cmd,
+        cwd=str(cwd),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1
+    )
+    
+    timed_out = threading.Event()
+    
+    def kill():
+        timed_out.set()
+        proc.kill()
+    
+    tail = deque(maxlen=tail_lines)
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        # Text mode splits tqdm's carriage-return updates into separate lines
+        for line in proc.stdout:
+            line = line.rstrip()
+            if line:
+                tail.append(line)
+        proc.wait()
+    finally:
+        timer.cancel()
+        proc.stdout.close()
+    
+    return (None if timed_out.is_set() else proc.returncode), tail
+
 
 class Wan22VideoService:
     """Generate video clips from images using local Wan 2.2 I2V model"""
     
+    _worker_disabled = False  # Set once the worker fails so later scenes skip straight to generate.py
+    
     def __init__(
         self,
         repo_path: str = WAN_REPO_PATH,
@@ -35,6 +84,8 @@ class Wan22VideoService:
         """
         self.repo_path = Path(repo_path)
         self.model_path = Path(model_path)
+        self._worker: Optional[subprocess.Popen] = None
+        self._worker_key = None
         self._check_installation()
     
     def _check_installation(self):
@@ -63,7 +114,7 @@ class Wan22VideoService:
         self,
         image_path: Path,
         prompt: str,
-        output_path: Optional[Path] = None,
+        output_path: Path,
         size: str = WAN_VIDEO_SIZE,
         offload_model: bool = WAN_OFFLOAD_MODEL,
         t5_cpu: bool = WAN_T5_CPU,
@@ -75,7 +126,7 @@ class Wan22VideoService:
         Args:
             image_path: Path to input image
             prompt: Motion/scene description
-            output_path: Full output file path (optional)
+            output_path: Full output file path
             size: Video size (e.g., '720*1280' for vertical)
             offload_model: Offload model to save VRAM
             t5_cpu: Run T5 encoder on CPU
@@ -119,49 +170,191 @@ class Wan22VideoService:
         cmd.extend(["--sample_steps", str(sample_steps)])
         
         # Use --save_file for output path (not --save_dir)
-        if output_path:
-            output_path = Path(output_path)
-            output_path.parent.mkdir(parents=True, exist_ok=True)
-            cmd.extend(["--save_file", str(output_path)])
+        # generate.py runs with cwd=repo_path, so a relative path would land inside the Wan checkout
+        output_path = Path(output_path).absolute()
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        cmd.extend(["--save_file", str(output_path)])
         
         print(f"🎬 Generating video with Wan 2.2...")
         print(f"   Image: {image_path.name}")
         print(f"   Prompt: {prompt[:60]}...")
         
-        # Run generation
+        # Prefer the persistent worker, which keeps the model loaded between scenes
+        video_path = self._generate_with_worker(
+            image_path, prompt, output_path, size, sample_steps, offload_model, t5_cpu
+        )
+        if video_path:
+            print(f"✅ Video generated: {video_path}")
+            return video_path
+        
+        return self._run_generate(cmd, output_path)
+    
+    def _run_generate(self, cmd: list, output_path: Path) -> Path:
+        """Run generate.py as a one-shot subprocess (reloads the model every call)"""
+        returncode, tail = _run_streaming(cmd, cwd=self.repo_path, timeout=GENERATION_TIMEOUT)
+        
+        if returncode is None:
+            raise RuntimeError("Video generation timed out (30 min limit)")
+        
+        if returncode != 0:
+            log = "\n".join(tail)
+            print(f"❌ Wan 2.2 error:\n{log[-1000:]}")
+            raise RuntimeError(f"Video generation failed: {log[-500:]}")
+        
+        if not output_path.exists():
+            raise RuntimeError(f"No video file generated at {output_path}")
+        
+        print(f"✅ Video generated: {output_path}")
+        return output_path
+    
+    def _start_worker(self, offload_model: bool, t5_cpu: bool) -> Optional[subprocess.Popen]:
+        """Start (or reuse) the persistent worker for the given load options"""
+        if self._worker_disabled:
+            return None
+        key = (str(self.model_path), offload_model, t5_cpu)
+        if self._worker is not None and self._worker.poll() is None and self._worker_key == key:
+            return self._worker
+        self.unload()
+        
+        cmd = [
+            sys.executable,
+            str(WORKER_SCRIPT),
+            "--task", "ti2v-5B",
+            "--ckpt_dir", str(self.model_path),
+            "--convert_model_dtype",
+        ]
+        if offload_model:
+            cmd.append("--offload_model")
+        if t5_cpu:
+            cmd.append("--t5_cpu")
+        
+        print("🔄 Starting Wan 2.2 worker (model loads once per run)...")
         try:
-            result = subprocess.run(
+            # stderr is inherited so load/progress logs stay visible without filling a pipe
+            worker = subprocess.Popen(
                 cmd,
                 cwd=str(self.repo_path),
-                capture_output=True,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
                 text=True,
-                timeout=1800  # 30 minute timeout
+                bufsize=1
             )
-            
-            if result.returncode != 0:
-                print(f"❌ Wan 2.2 error:\n{result.stderr[-1000:]}")
-                raise RuntimeError(f"Video generation failed: {result.stderr[-500:]}")
-            
-            # If output_path was specified, return it
-            if output_path and output_path.exists():
-                print(f"✅ Video generated: {output_path}")
-                return output_path
-            
-            # Otherwise find generated video in default output
-            save_dir = self.repo_path / "output"
-            video_files = list(save_dir.glob("*.mp4"))
-            
-            if not video_files:
-                raise RuntimeError("No video file generated")
-            
-            # Get most recent video
-            latest_video = max(video_files, key=lambda p: p.stat().st_mtime)
-            
-            print(f"✅ Video generated: {latest_video}")
-            return latest_video
-            
-        except subprocess.TimeoutExpired:
+        except OSError as e:
+            print(f"⚠️ Could not start Wan worker: {e}")
+            self._worker_disabled = True
+            return None
+        
+        # A worker that hangs while loading would otherwise block readline forever
+        load_timed_out = threading.Event()
+        
+        def kill_loading():
+            load_timed_out.set()
+            worker.kill()
+        
+        timer = threading.Timer(GENERATION_TIMEOUT, kill_loading)
+        timer.start()
+        try:
+            ready = worker.stdout.readline().strip()
+        finally:
+            timer.cancel()
+        
+        if ready != "READY":
+            if load_timed_out.is_set():
+                print("⚠️ Wan worker timed out while loading, falling back to generate.py")
+            else:
+                print("⚠️ Wan worker failed to load, falling back to generate.py")
+            worker.kill()
+            worker.wait()
+            self._worker_disabled = True
+            return None
+        
+        self._worker = worker
+        self._worker_key = key
+        return worker
+    
+    def _generate_with_worker(
+        self,
+        image_path: Path,
+        prompt: str,
+        output_path: Path,
+        size: str,
+        sample_steps: int,
+        offload_model: bool,
+        t5_cpu: bool
+    ) -> Optional[Path]:
+        """
+        Generate one clip through the persistent worker.
+        
+        Returns:
+            Path to generated video, or None if the worker is unavailable
+        """
+        worker = self._start_worker(offload_model, t5_cpu)
+        if worker is None:
+            return None
+        
+        request = {
+            "image": str(image_path),
+            "prompt": prompt,
+            "save_file": str(Path(output_path).absolute()),
+            "size": size,
+            "sample_steps": sample_steps,
+        }
+        
+        # Kill a hung worker so readline returns instead of blocking forever
+        timed_out = threading.Event()
+        
+        def kill():
+            timed_out.set()
+            worker.kill()
+        
+        timer = threading.Timer(GENERATION_TIMEOUT, kill)
+        timer.start()
+        try:
+            worker.stdin.write(json.dumps(request) + "\n")
+            worker.stdin.flush()
+            reply = worker.stdout.readline()
+        except (BrokenPipeError, OSError):
+            reply = ""
+        finally:
+            timer.cancel()
+        
+        if timed_out.is_set():
+            # Don't rerun the clip through generate.py (another 30 minutes) or give up on the
+            # worker; the next scene starts a fresh one
+            self.unload()
             raise RuntimeError("Video generation timed out (30 min limit)")
+        
+        if not reply:
+            print("⚠️ Wan worker exited, falling back to generate.py")
+            self.unload()
+            self._worker_disabled = True
+            return None
+        
+        status, _, detail = reply.rstrip("\n").partition("\t")
+        if status != "OK":
+            raise RuntimeError(f"Video generation failed: {detail}")
+        return Path(detail)
+    
+    def unload(self):
+        """Shut down the persistent worker and free its VRAM"""
+        worker, self._worker = self._worker, None
+        self._worker_key = None
+        if worker is None:
+            return
+        
+        try:
+            worker.stdin.close()  # EOF tells the worker to exit
+            worker.wait(timeout=30)
+        except (OSError, subprocess.TimeoutExpired):
+            worker.kill()
+            worker.wait()
+        print("🧹 Wan 2.2 worker stopped")
+    
+    def __del__(self):
+        try:
+            self.unload()
+        except Exception:
+            pass
     
     def generate_to_file(
         self,
@@ -190,13 +383,15 @@ class Wan22TI2VService(Wan22VideoService):
     def __init__(self, repo_path: str = WAN_REPO_PATH):
         self.repo_path = Path(repo_path)
         self.model_path = Path(repo_path).parent / "Wan2.2-TI2V-5B"
+        self._worker: Optional[subprocess.Popen] = None
+        self._worker_key = None
         self._check_installation()
     
     def generate_video(
         self,
         image_path: Path,
         prompt: str,
-        output_path: Optional[Path] = None,
+        output_path: Path,
         size: str = "704*1280",  # TI2V uses different resolution
         sample_steps: int = 10,  # Lower = faster
         **kwargs
@@ -222,31 +417,18 @@ class Wan22TI2VService(Wan22VideoService):
             "--sample_steps", str(sample_steps),
         ]
         
-        if output_path:
-            output_path = Path(output_path)
-            output_path.parent.mkdir(parents=True, exist_ok=True)
-            cmd.extend(["--save_file", str(output_path)])
+        # generate.py runs with cwd=repo_path, so a relative path would land inside the Wan checkout
+        output_path = Path(output_path).absolute()
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        cmd.extend(["--save_file", str(output_path)])
         
         print(f"🎬 Generating video with Wan 2.2 TI2V-5B...")
         
-        result = subprocess.run(
-            cmd,
-            cwd=str(self.repo_path),
-            capture_output=True,
-            text=True,
-            timeout=1800  # 30 minute timeout
+        video_path = self._generate_with_worker(
+            image_path, prompt, output_path, size, sample_steps,
+            offload_model=True, t5_cpu=True
         )
+        if video_path:
+            return video_path
         
-        if result.returncode != 0:
-            raise RuntimeError(f"Video generation failed: {result.stderr[-500:]}")
-        
-        if output_path and output_path.exists():
-            return output_path
-        
-        save_dir = self.repo_path / "output"
-        video_files = list(save_dir.glob("*.mp4"))
-        
-        if not video_files:
-            raise RuntimeError("No video file generated")
-        
-        return max(video_files, key=lambda p: p.stat().st_mtime)
+        return self._run_generate(cmd, output_path)
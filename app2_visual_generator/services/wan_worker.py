@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Wan 2.2 persistent worker.
+Loads the pipeline once, then serves generation requests from stdin.
+
+Run with the Wan2.2 repo as the working directory. Protocol (one line each):
+    stdin:  {"image": ..., "prompt": ..., "save_file": ..., "size": ..., "sample_steps": ...}
+    stdout: READY once loaded, then OK\t<path> or ERR\t<message> per request
+"""
+
+import argparse
+import json
+import os
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Persistent Wan 2.2 generation worker")
+    parser.add_argument("--task", type=str, default="ti2v-5B")
+    parser.add_argument("--ckpt_dir", type=str, required=True)
+    parser.add_argument("--offload_model", action="store_true")
+    parser.add_argument("--t5_cpu", action="store_true")
+    parser.add_argument("--convert_model_dtype", action="store_true")
+    args = parser.parse_args()
+
+    # stdout is reserved for the protocol; route everything else (including C-level writes) to stderr
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), "w", buffering=1)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    sys.path.insert(0, os.getcwd())
+    import torch
+    from PIL import Image
+    import wan
+    from wan.configs import WAN_CONFIGS, SIZE_CONFIGS, MAX_AREA_CONFIGS
+    from wan.utils.utils import save_video
+
+    cfg = WAN_CONFIGS[args.task]
+    pipeline = wan.WanTI2V(
+        config=cfg,
+        checkpoint_dir=args.ckpt_dir,
+        device_id=0,
+        rank=0,
+        t5_cpu=args.t5_cpu,
+        convert_model_dtype=args.convert_model_dtype,
+    )
+    protocol.write("READY\n")
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            size = request.get("size", "704*1280")
+            img = Image.open(request["image"]).convert("RGB")
+
+            video = pipeline.generate(
+                request["prompt"],
+                img=img,
+                size=SIZE_CONFIGS[size],
+                max_area=MAX_AREA_CONFIGS[size],
+                frame_num=cfg.frame_num,
+                shift=cfg.sample_shift,
+                sample_solver="unipc",
+                sampling_steps=request.get("sample_steps", cfg.sample_steps),
+                guide_scale=cfg.sample_guide_scale,
+                seed=request.get("seed", -1),
+                offload_model=args.offload_model,
+            )
+            save_video(
+                tensor=video[None],
+                save_file=request["save_file"],
+                fps=cfg.sample_fps,
+                nrow=1,
+                normalize=True,
+                value_range=(-1, 1),
+            )
+            del video
+            torch.cuda.empty_cache()
+            protocol.write(f"OK\t{request['save_file']}\n")
+        except Exception as e:
+            message = str(e).replace("\n", " ")
+            protocol.write(f"ERR\t{type(e).__name__}: {message}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,16 +4,18 @@ Offline image generation using Z-Image-Turbo model.
 https://github.com/Tongyi-MAI/Z-Image
 """
 
-import torch
+import hashlib
+from collections import OrderedDict
 from pathlib import Path
 from typing import Optional
-import sys
 
-sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 from shared.config import (
-    ZIMAGE_MODEL, ZIMAGE_DEVICE, VIDEO_WIDTH, VIDEO_HEIGHT,
-    TORCH_DTYPE, LOW_VRAM_MODE
+    ZIMAGE_MODEL, ZIMAGE_DEVICE, ZIMAGE_QUANT, ZIMAGE_COMPILE, VIDEO_WIDTH, VIDEO_HEIGHT,
+    TORCH_DTYPE, LOW_VRAM_MODE, ZIMAGE_OFFLOAD
 )
+from .cuda_memory import enable_fast_matmul, release_cuda_memory
+
+PROMPT_CACHE_SIZE = 32  # Encoded prompts kept on device
 
 
 class ZImageService:
@@ -23,7 +25,9 @@ class ZImageService:
         self,
         model_id: str = ZIMAGE_MODEL,
         device: str = ZIMAGE_DEVICE,
-        dtype: str = TORCH_DTYPE
+        dtype: str = TORCH_DTYPE,
+        quant: str = ZIMAGE_QUANT,
+        compile: bool = ZIMAGE_COMPILE
     ):
         """
         Initialize Z-Image pipeline.
@@ -32,12 +36,19 @@ class ZImageService:
             model_id: HuggingFace model ID or local path
             device: 'cuda' or 'cpu'
             dtype: 'bfloat16', 'float16', or 'float32'
+            quant: Transformer weight storage: 'fp8', 'int8', or 'none'
+            compile: torch.compile the transformer (ignored off CUDA)
         """
         self.model_id = model_id
         self.device = device
-        self.dtype = getattr(torch, dtype)
+        self.dtype = dtype
+        self.quant = quant
+        self.compile = compile and device.startswith("cuda")
         self.pipe = None
         self._loaded = False
+        
+        # Text-encoder outputs keyed by prompt hash, most recently used last
+        self._prompt_cache: OrderedDict[str, object] = OrderedDict()
     
     def load_model(self):
         """Load the Z-Image pipeline (call explicitly due to memory)"""
@@ -48,19 +59,39 @@ class ZImageService:
         print("   This may take a while on first run...")
         
         try:
+            import torch
             from diffusers import ZImagePipeline
             
+            enable_fast_matmul()
+            
             self.pipe = ZImagePipeline.from_pretrained(
                 self.model_id,
-                torch_dtype=self.dtype,
+                torch_dtype=getattr(torch, self.dtype),
                 low_cpu_mem_usage=True,
             )
-            self.pipe.to(self.device)
             
-            # Memory optimizations
-            if LOW_VRAM_MODE:
-                print("   Enabling memory optimizations...")
+            self._quantize_transformer()
+            
+            # Offload hooks manage device placement themselves, so only move the pipe without them
+            if ZIMAGE_OFFLOAD == "sequential":
+                print("   Enabling sequential CPU offload...")
+                self.pipe.enable_sequential_cpu_offload()
+            elif ZIMAGE_OFFLOAD == "model":
+                print("   Enabling model CPU offload...")
                 self.pipe.enable_model_cpu_offload()
+            else:
+                self.pipe.to(self.device)
+            
+            # Decode the VAE in tiles so peak memory doesn't scale with resolution
+            self.pipe.vae.enable_tiling()
+            if LOW_VRAM_MODE:
+                self.pipe.vae.enable_slicing()
+            
+            self._enable_fast_attention()
+            
+            # Per-layer offload hooks break the graph on every layer, so only compile without them
+            if self.compile and ZIMAGE_OFFLOAD != "sequential":
+                self._compile_transformer()
             
             self._loaded = True
             print("✅ Z-Image loaded successfully")
@@ -71,6 +102,153 @@ class ZImageService:
                 "pip install git+https://github.com/huggingface/diffusers"
             )
     
+    def _quantize_transformer(self):
+        """Shrink transformer weights before they are moved to the GPU"""
+        if self.quant in ("", "none"):
+            return
+        
+        import torch
+        
+        if self.quant == "fp8":
+            # Weights are stored as FP8 and upcast per layer for bf16 compute; norms stay full precision
+            print("   Storing transformer weights in FP8...")
+            self.pipe.transformer.enable_layerwise_casting(
+                storage_dtype=torch.float8_e4m3fn,
+                compute_dtype=getattr(torch, self.dtype)
+            )
+        elif self.quant == "int8":
+            try:
+                from optimum.quanto import quantize, freeze, qint8
+            except ImportError:
+                print("⚠️ optimum-quanto not installed, skipping INT8 quantization")
+                return
+            print("   Quantizing transformer weights to INT8...")
+            quantize(self.pipe.transformer, weights=qint8)
+            freeze(self.pipe.transformer)
+        else:
+            print(f"⚠️ Unknown quantization '{self.quant}', keeping {self.dtype}")
+    
+    def _enable_fast_attention(self):
+        """Use the FlashAttention backend when available (diffusers defaults to PyTorch SDPA)"""
+        try:
+            self.pipe.transformer.set_attention_backend("flash")
+            print("   Using FlashAttention backend")
+        except Exception:
+            pass
+    
+    def _compile_transformer(self):
+        """
+        Compile the transformer in place and warm it up so the first scene doesn't pay for it.
+        
+        Tries CUDA graphs first (when weights are resident), then plain Inductor,
+        and keeps the eager transformer if every mode fails.
+        """
+        # Turbo runs a fixed 9-step loop at one resolution, so CUDA graphs can replay every step.
+        # Graphs need weights resident on the GPU, which offload hooks don't guarantee.
+        modes = ["reduce-overhead", "default"] if ZIMAGE_OFFLOAD == "none" else ["default"]
+        
+        for mode in modes:
+            print(f"   Compiling transformer ({mode}, one-time warmup)...")
+            try:
+                self.pipe.transformer.compile(mode=mode, fullgraph=False)
+                self._warmup()
+                print(f"   Transformer compiled ({mode})")
+                return
+            except Exception as e:
+                print(f"⚠️ torch.compile ({mode}) failed: {e}")
+                self._uncompile_transformer()
+        
+        print("   Using the eager transformer")
+    
+    def _warmup(self):
+        """One step at the real resolution triggers compilation (and cuDNN autotuning) now rather than mid-story"""
+        import torch
+        
+        with torch.inference_mode():
+            self.pipe(
+                prompt="warmup",
+                height=VIDEO_HEIGHT,
+                width=VIDEO_WIDTH,
+                num_inference_steps=1,
+                guidance_scale=0.0,
+            )
+    
+    def _uncompile_transformer(self):
+        """Drop the compiled forward set by Module.compile() so calls run eagerly again"""
+        import torch
+        
+        self.pipe.transformer._compiled_call_impl = None
+        torch._dynamo.reset()
+    
+    def _prompt_key(self, prompt: str) -> str:
+        return hashlib.blake2b(f"{self.model_id}\0{prompt}".encode(), digest_size=16).hexdigest()
+    
+    def encode_prompt(self, prompt: str):
+        """
+        Run the text encoder for a prompt, reusing the result for repeated prompts.
+        
+        Returns:
+            prompt_embeds for the pipeline, or None if the pipeline can't encode separately
+        """
+        key = self._prompt_key(prompt)
+        if key in self._prompt_cache:
+            self._prompt_cache.move_to_end(key)
+            return self._prompt_cache[key]
+        
+        import torch
+        
+        try:
+            with torch.inference_mode():
+                prompt_embeds, _ = self.pipe.encode_prompt(
+                    prompt=prompt,
+                    do_classifier_free_guidance=False
+                )
+        except (AttributeError, TypeError):
+            return None  # Older pipeline without a standalone encode_prompt
+        
+        self._prompt_cache[key] = prompt_embeds
+        if len(self._prompt_cache) > PROMPT_CACHE_SIZE:
+            self._prompt_cache.popitem(last=False)
+        return prompt_embeds
+    
+    def encode_prompts(self, prompts: list[str]):
+        """
+        Encode several prompts in one text-encoder pass and cache each result.
+        
+        Call before a generation loop so per-image calls hit the cache.
+        Falls back to encoding one at a time if the batch call fails.
+        """
+        if not self._loaded:
+            self.load_model()
+        
+        pending = [p for p in prompts if self._prompt_key(p) not in self._prompt_cache]
+        pending = pending[:PROMPT_CACHE_SIZE]
+        if len(pending) < 2:
+            for prompt in pending:
+                self.encode_prompt(prompt)
+            return
+        
+        import torch
+        
+        print(f"   Encoding {len(pending)} prompts...")
+        try:
+            with torch.inference_mode():
+                prompt_embeds, _ = self.pipe.encode_prompt(
+                    prompt=pending,
+                    do_classifier_free_guidance=False
+                )
+        except (AttributeError, TypeError):
+            return  # Older pipeline without a standalone encode_prompt
+        except Exception as e:
+            print(f"⚠️ Batched prompt encoding failed ({e}), encoding per image")
+            return
+        
+        # Slicing keeps the pipeline's own container type (list of tensors or batched tensor)
+        for i, prompt in enumerate(pending):
+            self._prompt_cache[self._prompt_key(prompt)] = prompt_embeds[i:i + 1]
+        while len(self._prompt_cache) > PROMPT_CACHE_SIZE:
+            self._prompt_cache.popitem(last=False)
+    
     def generate(
         self,
         prompt: str,
@@ -97,6 +275,8 @@ class ZImageService:
         if not self._loaded:
             self.load_model()
         
+        import torch
+        
         # Setup generator for reproducibility
         generator = None
         if seed is not None:
@@ -105,14 +285,19 @@ class ZImageService:
         print(f"🎨 Generating image...")
         print(f"   Prompt: {prompt[:60]}...")
         
-        result = self.pipe(
-            prompt=prompt,
-            height=height,
-            width=width,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            generator=generator,
-        )
+        # Turbo runs without CFG, so there's no negative prompt to encode
+        prompt_embeds = self.encode_prompt(prompt) if guidance_scale <= 1.0 else None
+        prompt_args = {"prompt_embeds": prompt_embeds} if prompt_embeds is not None else {"prompt": prompt}
+        
+        with torch.inference_mode():
+            result = self.pipe(
+                **prompt_args,
+                height=height,
+                width=width,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                generator=generator,
+            )
         
         image = result.images[0]
         print("✅ Image generated")
@@ -140,9 +325,7 @@ class ZImageService:
         if self.pipe is not None:
             del self.pipe
             self.pipe = None
+            self._prompt_cache.clear()
             self._loaded = False
             
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            
-            print("🧹 Z-Image unloaded")
+            release_cuda_memory("Z-Image")
@@ -5,19 +5,52 @@ Generates consistent images and converts them to video clips.
 Pipeline: Z-Image (diffusers) → Qwen-Image-Edit → Wan 2.2 (local)
 """
 
-import json
 import argparse
+import functools
+import hashlib
+import shutil
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from shared.config import OUTPUT_DIR, LOW_VRAM_MODE
+from shared.config import (
+    OUTPUT_DIR, LOW_VRAM_MODE, QWEN_EDIT_BATCH_SIZE, INTERMEDIATE_FORMAT,
+    VIDEO_WIDTH, VIDEO_HEIGHT
+)
 from shared.models import Story, VisualAsset
+from shared.json_utils import write_json_atomic
 from app2_visual_generator.services import ZImageService, QwenImageEditService, SimpleConsistencyService, Wan22VideoService
 
 
+# Intermediate scene images; the character reference always stays lossless PNG
+IMAGE_EXT = ".jpg" if INTERMEDIATE_FORMAT == "jpeg" else ".png"
+BASE_IMAGE_NAME = f"base_image{IMAGE_EXT}"
+CONSISTENT_IMAGE_NAME = f"consistent_image{IMAGE_EXT}"
+
+
+def _save_image(image, output_path: Path, copy_to: Optional[Path] = None):
+    """
+    Save a PIL image by extension, optionally also writing a PNG copy.
+    
+    JPEG q95 goes through Pillow's libjpeg-turbo encoder and is several
+    times faster than PNG; PNG uses compress_level=1 (~5x faster than 6).
+    """
+    if output_path.suffix == ".jpg":
+        image.save(output_path, format="JPEG", quality=95)
+    else:
+        image.save(output_path, format="PNG", compress_level=1, optimize=False)
+    
+    if copy_to is None:
+        return
+    if copy_to.suffix == output_path.suffix:
+        shutil.copyfile(output_path, copy_to)
+    else:
+        image.save(copy_to, format="PNG", compress_level=1, optimize=False)
+
+
 class VisualGenerator:
     """Generate visual assets for story scenes using local models"""
     
@@ -25,7 +58,8 @@ class VisualGenerator:
         self,
         enable_consistency: bool = True,
         enable_video: bool = True,
-        low_vram: bool = LOW_VRAM_MODE
+        low_vram: bool = LOW_VRAM_MODE,
+        edit_batch_size: int = QWEN_EDIT_BATCH_SIZE
     ):
         """
         Initialize visual generator with local models.
@@ -34,9 +68,8 @@ class VisualGenerator:
             enable_consistency: Use Qwen-Image-Edit for character consistency
             enable_video: Generate video clips with Wan 2.2
             low_vram: Enable memory-saving mode
+            edit_batch_size: Scenes per Qwen-Image-Edit forward pass
         """
-        self.zimage = ZImageService()
-        
         # Try Qwen-Image-Edit, fall back to simple service
         if enable_consistency:
             try:
@@ -52,13 +85,33 @@ class VisualGenerator:
         self.enable_consistency = enable_consistency
         self.enable_video = enable_video
         self.low_vram = low_vram
+        self.edit_batch_size = max(1, edit_batch_size)
         
         self.character_reference_path: Optional[Path] = None
+        self.character_reference_image = None  # PIL.Image kept in memory for the edit phase
+        
+        # Image saves run in the background so they overlap the next GPU step
+        self._io_pool = ThreadPoolExecutor(max_workers=2)
+        self._pending_saves: dict[Path, Future] = {}
+        
+        # Base images by enhanced-prompt hash, for the story being processed
+        self._prompt_cache: dict[str, object] = {}
+    
+    @functools.cached_property
+    def zimage(self) -> ZImageService:
+        """Z-Image service, created on first use so --help and manifest-only runs stay light"""
+        return ZImageService()
     
     def process_story(self, story: Story, output_dir: Path) -> list[VisualAsset]:
         """
         Process all scenes in a story.
         
+        Runs in three phases so each model is loaded once and can be
+        unloaded before the next: Z-Image base images for every scene,
+        then batched Qwen-Image-Edit consistency, then Wan 2.2 clips.
+        Outside low-VRAM mode, each clip starts as soon as its final
+        image is ready, overlapping Wan with the image phases.
+        
         Args:
             story: Story object with scenes
             output_dir: Directory to save visual assets
@@ -69,119 +122,236 @@ class VisualGenerator:
         output_dir = Path(output_dir)
         output_dir.mkdir(parents=True, exist_ok=True)
         
-        assets = []
+        scenes = story.scenes
+        scene_dirs = {scene.scene_id: output_dir / f"scene_{scene.scene_id:03d}" for scene in scenes}
+        self.character_reference_path = None
+        self.character_reference_image = None
+        self._prompt_cache.clear()
         
-        print(f"\n🎬 Processing {len(story.scenes)} scenes for '{story.title}'")
+        print(f"\n🎬 Processing {len(scenes)} scenes for '{story.title}'")
         print("=" * 50)
         
-        # Pre-load Z-Image model
+        # Wan runs one clip at a time; jobs queue here as final images become ready
+        video_pool = ThreadPoolExecutor(max_workers=1)
+        video_jobs: dict[int, Future] = {}
+        make_video = self.enable_video and self.video and self.video.available
+        overlap_video = make_video and not self.low_vram
+        
+        def submit_video(scene, image_path: Path):
+            video_jobs[scene.scene_id] = video_pool.submit(
+                self._generate_video_clip, scene, image_path, scene_dirs[scene.scene_id] / "video_clip.mp4"
+            )
+        
+        # Build every prompt up front so the text encoder runs once for the whole story
+        enhanced_prompts = {
+            scene.scene_id: self._enhance_prompt(
+                scene.visual_prompt,
+                story.character_reference,
+                scene.character_description
+            )
+            for scene in scenes
+        }
+        
+        # Phase 1: base images with Z-Image
         print("\n🔄 Loading Z-Image model...")
         self.zimage.load_model()
+        self.zimage.encode_prompts(list(dict.fromkeys(enhanced_prompts.values())))
         
-        for i, scene in enumerate(story.scenes):
-            print(f"\n📍 Scene {scene.scene_id}/{len(story.scenes)}")
+        base_images: dict[int, object] = {}  # PIL.Image per scene_id
+        for i, scene in enumerate(scenes):
+            print(f"\n📍 Scene {scene.scene_id}/{len(scenes)}")
             
-            scene_dir = output_dir / f"scene_{scene.scene_id:03d}"
+            scene_dir = scene_dirs[scene.scene_id]
             scene_dir.mkdir(exist_ok=True)
             
             try:
-                asset = self._process_scene(
+                base_images[scene.scene_id] = self._generate_base_image(
                     scene=scene,
                     scene_dir=scene_dir,
-                    character_reference=story.character_reference,
+                    enhanced_prompt=enhanced_prompts[scene.scene_id],
                     is_first_scene=(i == 0)
                 )
-                assets.append(asset)
-                
             except Exception as e:
                 print(f"❌ Error processing scene {scene.scene_id}: {e}")
-                assets.append(VisualAsset(
-                    scene_id=scene.scene_id,
-                    base_image_path=str(scene_dir / "base_image.png")
-                ))
+                continue
+            
+            # The base image is final unless the scene goes through the edit phase
+            will_edit = i > 0 and self.consistency and self.character_reference_image is not None
+            if overlap_video and not will_edit:
+                submit_video(scene, scene_dir / BASE_IMAGE_NAME)
         
-        # Unload Z-Image to free memory for video generation
-        if self.low_vram and self.enable_video:
+        # Unload Z-Image to free memory for the edit and video models
+        if self.low_vram and (self.enable_consistency or self.enable_video):
             self.zimage.unload_model()
         
+        # Phase 2: character consistency for every scene after the first
+        consistent_images: dict[int, Path] = {}
+        if self.enable_consistency and self.consistency:
+            if self.character_reference_image is not None:
+                pending = [scene for scene in scenes[1:] if scene.scene_id in base_images]
+                consistent_images = self._apply_consistency(
+                    pending, base_images, scene_dirs,
+                    on_ready=submit_video if overlap_video else None
+                )
+            
+            if self.low_vram and self.enable_video:
+                self.consistency.unload_model()
+        
+        # Phase 3: video clips with Wan 2.2 (already queued when overlapping)
+        if make_video and not overlap_video:
+            for scene in scenes:
+                if scene.scene_id in base_images:
+                    submit_video(
+                        scene,
+                        consistent_images.get(scene.scene_id) or scene_dirs[scene.scene_id] / BASE_IMAGE_NAME
+                    )
+        
+        video_clips = {scene_id: job.result() for scene_id, job in video_jobs.items()}
+        video_pool.shutdown()
+        
+        # Stop the Wan worker so its VRAM is free for later pipeline steps
+        if self.video:
+            self.video.unload()
+        
+        self._wait_for_save()
+        
+        assets = []
+        for scene in scenes:
+            consistent_image_path = consistent_images.get(scene.scene_id)
+            video_path = video_clips.get(scene.scene_id)
+            assets.append(VisualAsset(
+                scene_id=scene.scene_id,
+                base_image_path=str(scene_dirs[scene.scene_id] / BASE_IMAGE_NAME),
+                consistent_image_path=str(consistent_image_path) if consistent_image_path else None,
+                video_clip_path=str(video_path) if video_path else None
+            ))
+        
         print(f"\n✅ Processed {len(assets)} scenes")
         return assets
     
-    def _process_scene(
+    def _generate_base_image(
         self,
         scene,
         scene_dir: Path,
-        character_reference: Optional[str],
+        enhanced_prompt: str,
         is_first_scene: bool
-    ) -> VisualAsset:
-        """Process a single scene through the visual pipeline"""
+    ):
+        """
+        Generate a scene's base image with Z-Image (first scene also becomes the reference).
         
-        # Step 1: Generate base image with Z-Image
+        Returns:
+            PIL.Image (saved as the scene's base image in the background)
+        """
         print(f"   🎨 Generating base image...")
-        base_image_path = scene_dir / "base_image.png"
+        base_image_path = scene_dir / BASE_IMAGE_NAME
         
-        enhanced_prompt = self._enhance_prompt(
-            scene.visual_prompt,
-            character_reference,
-            scene.character_description
-        )
-        
-        self.zimage.generate_to_file(
-            prompt=enhanced_prompt,
-            output_path=base_image_path
-        )
+        # Identical prompts (repeated establishing shots, B-roll) reuse the earlier image
+        key = hashlib.blake2b(
+            f"{enhanced_prompt}|{VIDEO_WIDTH}|{VIDEO_HEIGHT}".encode(), digest_size=16
+        ).hexdigest()
+        image = self._prompt_cache.get(key)
+        if image is None:
+            image = self.zimage.generate(prompt=enhanced_prompt)
+            self._prompt_cache[key] = image
+        else:
+            print(f"   ♻️ Reusing image from an identical scene prompt")
         
-        # Step 2: Save first scene as character reference
+        # Save first scene as character reference (a file copy when the formats match)
         if is_first_scene and self.enable_consistency:
             self.character_reference_path = scene_dir / "character_reference.png"
-            self.character_reference_path.write_bytes(base_image_path.read_bytes())
+            self.character_reference_image = image
+            self._save_async(image, base_image_path, copy_to=self.character_reference_path)
             print(f"   📌 Saved character reference")
+        else:
+            self._save_async(image, base_image_path)
         
-        # Step 3: Apply character consistency (if not first scene)
-        consistent_image_path = None
-        if self.enable_consistency and self.consistency and not is_first_scene:
-            if self.character_reference_path and self.character_reference_path.exists():
-                print(f"   🔄 Applying character consistency...")
-                consistent_image_path = scene_dir / "consistent_image.png"
-                
-                try:
-                    self.consistency.apply_to_file(
-                        source_image=base_image_path,
-                        reference_image=self.character_reference_path,
-                        output_path=consistent_image_path,
-                        prompt=scene.visual_prompt,
-                        character_description=scene.character_description or ""
-                    )
-                except Exception as e:
-                    print(f"   ⚠️ Consistency failed: {e}")
-                    consistent_image_path = None
+        return image
+    
+    def _apply_consistency(
+        self,
+        scenes: list,
+        base_images: dict[int, object],
+        scene_dirs: dict[int, Path],
+        on_ready: Optional[Callable] = None
+    ) -> dict[int, Path]:
+        """
+        Apply character consistency to scenes in batches.
         
-        final_image = consistent_image_path or base_image_path
+        Args:
+            scenes: Scenes to edit (all have a base image)
+            base_images: Base PIL.Image per scene_id
+            scene_dirs: Output directory per scene_id
+            on_ready: Called with (scene, final_image_path) as each batch finishes
+            
+        Returns:
+            Consistent image path per scene_id (failed batches are left out)
+        """
+        results = {}
         
-        # Step 4: Generate video clip with Wan 2.2
-        video_path = None
-        if self.enable_video and self.video and self.video.available:
-            print(f"   🎬 Generating video clip with Wan 2.2...")
-            video_path = scene_dir / "video_clip.mp4"
+        for start in range(0, len(scenes), self.edit_batch_size):
+            batch = scenes[start:start + self.edit_batch_size]
             
-            motion_prompt = self._build_motion_prompt(scene)
+            print(f"\n🔄 Applying character consistency to scenes {', '.join(str(s.scene_id) for s in batch)}...")
             
             try:
-                self.video.generate_to_file(
-                    image_path=final_image,
-                    output_path=video_path,
-                    prompt=motion_prompt
+                images = self.consistency.apply_consistency_batch(
+                    [base_images[scene.scene_id] for scene in batch],
+                    self.character_reference_image,
+                    [scene.visual_prompt for scene in batch],
+                    [scene.character_description or "" for scene in batch]
                 )
             except Exception as e:
-                print(f"   ⚠️ Video generation failed: {e}")
-                video_path = None
-        
-        return VisualAsset(
-            scene_id=scene.scene_id,
-            base_image_path=str(base_image_path),
-            consistent_image_path=str(consistent_image_path) if consistent_image_path else None,
-            video_clip_path=str(video_path) if video_path else None
-        )
+                print(f"   ⚠️ Consistency failed: {e}")
+                images = []
+            
+            for scene, image in zip(batch, images):
+                output_path = scene_dirs[scene.scene_id] / CONSISTENT_IMAGE_NAME
+                self._save_async(image, output_path)
+                results[scene.scene_id] = output_path
+            
+            if on_ready:
+                for scene in batch:
+                    on_ready(scene, results.get(scene.scene_id) or scene_dirs[scene.scene_id] / BASE_IMAGE_NAME)
+        
+        return results
+    
+    def _generate_video_clip(self, scene, image_path: Path, video_path: Path) -> Optional[Path]:
+        """Generate one scene's clip with Wan 2.2; returns None on failure"""
+        print(f"\n🎬 Scene {scene.scene_id}: generating video clip with Wan 2.2...")
+        
+        try:
+            self._wait_for_save(image_path)  # Wan reads the image from disk
+            self.video.generate_to_file(
+                image_path=image_path,
+                output_path=video_path,
+                prompt=self._build_motion_prompt(scene)
+            )
+            return video_path
+        except Exception as e:
+            print(f"   ⚠️ Video generation failed for scene {scene.scene_id}: {e}")
+            return None
+    
+    def _save_async(self, image, output_path: Path, copy_to: Optional[Path] = None):
+        """Queue a PIL image save (and optional copy of the file) on the I/O pool"""
+        future = self._io_pool.submit(_save_image, image, Path(output_path), copy_to)
+        self._pending_saves[Path(output_path)] = future
+        if copy_to is not None:
+            self._pending_saves[Path(copy_to)] = future
+    
+    def _wait_for_save(self, path: Optional[Path] = None):
+        """Block until a queued save has hit disk (re-raises its error), or until every save has"""
+        if path is not None:
+            future = self._pending_saves.pop(Path(path), None)
+            if future is not None:
+                future.result()
+            return
+        
+        pending, self._pending_saves = self._pending_saves, {}
+        for pending_path, future in pending.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"⚠️ Failed to save {pending_path}: {e}")
     
     def _enhance_prompt(
         self,
@@ -220,13 +390,16 @@ class VisualGenerator:
     
     def save_assets_manifest(self, assets: list[VisualAsset], output_path: Path):
         """Save manifest of generated assets"""
+        # Don't list images that are still being written
+        self._wait_for_save()
+        
         manifest = {
-            "assets": [a.model_dump() for a in assets],
+            "assets": [a.model_dump(mode="json") for a in assets],
             "total_scenes": len(assets),
             "character_reference": str(self.character_reference_path) if self.character_reference_path else None
         }
         
-        output_path.write_text(json.dumps(manifest, indent=2))
+        write_json_atomic(output_path, manifest)
         print(f"💾 Manifest saved: {output_path}")
 
 
@@ -246,7 +419,7 @@ def main():
         print(f"❌ Story file not found: {story_path}")
         sys.exit(1)
     
-    story = Story.model_validate_json(story_path.read_text())
+    story = Story.model_validate_json(story_path.read_bytes())
     print(f"📖 Loaded story: '{story.title}'")
     
     if args.output:
@@ -1,3 +1,4 @@
 # Video Assembler Services
 from .tts_service import EdgeTTSService, VibeVoiceTTSService, TTSFactory
-from .ffmpeg_service import FFmpegService
+from .tts_cache import TTSCache
+from .ffmpeg_service import FFmpegService, Segment
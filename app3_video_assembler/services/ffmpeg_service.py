@@ -3,49 +3,419 @@ FFmpeg Service
 Video composition and assembly using FFmpeg.
 """
 
+import functools
+import heapq
+import mmap
+import os
 import subprocess
 import shutil
+import struct
+import tempfile
+import threading
+import wave
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional
-import sys
+from typing import Callable, List, Optional
 
-sys.path.insert(0, str(Path(__file__).parent.parent.parent))
-from shared.config import VIDEO_FPS, VIDEO_WIDTH, VIDEO_HEIGHT
+from shared.config import VIDEO_FPS, VIDEO_WIDTH, VIDEO_HEIGHT, VIDEO_ENCODER, FFMPEG_CONCURRENCY
+from shared.json_utils import loads
+
+try:
+    import av
+except ImportError:  # Optional: in-process remux, otherwise every mux forks ffmpeg
+    av = None
+
+try:
+    from mutagen.mp3 import MP3
+except ImportError:  # Optional: MP3 durations then come from ffprobe
+    MP3 = None
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+# Output args per H.264 encoder, tuned for roughly libx264's default quality
+ENCODER_ARGS = {
+    "h264_nvenc": ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq", "-rc", "vbr", "-cq", "23", "-b:v", "0"],
+    "h264_qsv": ["-c:v", "h264_qsv", "-preset", "medium", "-global_quality", "23"],
+    "h264_videotoolbox": ["-c:v", "h264_videotoolbox", "-b:v", "8M"],
+    "h264_amf": ["-c:v", "h264_amf", "-quality", "balanced", "-rc", "cqp", "-qp_i", "23", "-qp_p", "23"],
+    "libx264": ["-c:v", "libx264"],
+}
+# Hardware encoders in order of preference (NVIDIA, Intel, Apple, AMD)
+HW_ENCODERS = ["h264_nvenc", "h264_qsv", "h264_videotoolbox", "h264_amf"]
+
+FFMPEG_TIMEOUT = 300  # seconds
+
+# Past a few processes, parallel encodes contend for cores and encoder sessions and finish later, not sooner
+_ffmpeg_slots = threading.BoundedSemaphore(FFMPEG_CONCURRENCY)
+
+# Resolved once per process rather than walking PATH for every service/command
+_FFMPEG_PATH = shutil.which("ffmpeg")
+_FFPROBE_PATH = shutil.which("ffprobe")
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_encoders() -> frozenset:
+    """Names of the encoders this ffmpeg build was compiled with"""
+    if _FFMPEG_PATH is None:
+        return frozenset()
+    result = subprocess.run([_FFMPEG_PATH, "-hide_banner", "-encoders"], capture_output=True, text=True)
+    # Encoder lines look like " V....D h264_nvenc    NVIDIA NVENC H.264 encoder"
+    return frozenset(
+        parts[1] for parts in map(str.split, result.stdout.splitlines())
+        if len(parts) >= 2 and len(parts[0]) == 6
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _encoder_works(name: str) -> bool:
+    """
+    Check that a hardware encoder can actually encode.
+    
+    `ffmpeg -encoders` lists e.g. NVENC whenever it was compiled in, even
+    with no NVIDIA GPU or driver, so encode one tiny frame instead.
+    """
+    if name not in _compiled_encoders():
+        return False
+    cmd = [
+        _FFMPEG_PATH, "-hide_banner", "-v", "error",
+        "-f", "lavfi", "-i", "color=black:s=256x256",
+        "-frames:v", "1", "-pix_fmt", "yuv420p", "-c:v", name,
+        "-f", "null", "-"
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, timeout=30)
+    except (subprocess.TimeoutExpired, OSError):
+        return False
+    return result.returncode == 0
+
+
+@functools.lru_cache(maxsize=256)
+def _probe_cached(path: str, mtime_ns: int, size: int) -> dict:
+    """ffprobe streams + format as JSON; the stat fields key the cache"""
+    # Container headers carry everything we read, so don't let ffprobe scan packets
+    cmd = [
+        _FFPROBE_PATH or "ffprobe", "-v", "quiet",
+        "-probesize", "32K", "-analyzeduration", "0",
+        "-show_streams", "-show_format",
+        "-of", "json",
+        path
+    ]
+    # Only stdout is parsed; don't buffer stderr
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        return {}
+    return loads(result.stdout)
+
+
+def _probe(file_path: Path) -> dict:
+    """Probe a media file once per (path, mtime, size); treat the result as read-only"""
+    st = os.stat(file_path)
+    return _probe_cached(str(file_path), st.st_mtime_ns, st.st_size)
+
+
+def probe_duration(file_path: Path) -> float:
+    """Duration of a media file in seconds, memoized per (path, mtime, size)"""
+    info = _probe(file_path)
+    duration = info.get("format", {}).get("duration")
+    if duration is None:
+        # Some containers only record it per stream
+        duration = next((st["duration"] for st in info.get("streams", []) if "duration" in st), None)
+    if duration is None:
+        raise ValueError(f"Could not read duration of {file_path}")
+    return float(duration)
+
+
+def _wav_duration(path: str) -> Optional[float]:
+    """
+    Duration of a RIFF/WAVE file from its fmt and data chunk headers.
+    
+    Works for any sample format (float and extensible included, which
+    the wave module rejects) without reading the sample data.
+    
+    Returns:
+        Seconds, or None if the file isn't a plain RIFF/WAVE
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        if m[:4] != b"RIFF" or m[8:12] != b"WAVE":
+            return None
+        byte_rate = None
+        pos = 12
+        while pos + 8 <= len(m):
+            chunk_id, chunk_size = struct.unpack_from("<4sI", m, pos)
+            if chunk_id == b"fmt ":
+                byte_rate = struct.unpack_from("<I", m, pos + 16)[0]
+            elif chunk_id == b"data":
+                if not byte_rate:
+                    return None
+                # Streaming writers leave the size unset; the data then runs to EOF
+                available = len(m) - pos - 8
+                if chunk_size == 0 or chunk_size > available:
+                    chunk_size = available
+                return chunk_size / byte_rate
+            pos += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+
+@functools.lru_cache(maxsize=1024)
+def _audio_duration_cached(path: str, mtime_ns: int, size: int) -> float:
+    """Read the duration from the file header; ffprobe only for formats we can't parse"""
+    suffix = Path(path).suffix.lower()
+    try:
+        if suffix == ".wav":
+            duration = _wav_duration(path)
+            if duration is not None:
+                return duration
+            with wave.open(path, "rb") as wf:
+                return wf.getnframes() / float(wf.getframerate())
+        if suffix == ".mp3" and MP3 is not None:
+            return MP3(path).info.length
+        if soundfile is not None:
+            return soundfile.info(path).duration
+    except Exception:
+        pass
+    return probe_duration(Path(path))
+
+
+def audio_duration(file_path: Path) -> float:
+    """Duration of an audio file in seconds from its header, memoized per (path, mtime, size)"""
+    st = os.stat(file_path)
+    return _audio_duration_cached(str(file_path), st.st_mtime_ns, st.st_size)
+
+
+def audio_durations(paths: List[Path]) -> dict:
+    """
+    Durations of many audio files at once, keyed by path.
+    
+    Header reads are cheap, but any that fall back to ffprobe block on a
+    subprocess, so the lookups are overlapped on a thread pool.
+    """
+    paths = list(paths)
+    if len(paths) <= 1:
+        return {p: audio_duration(p) for p in paths}
+    with ThreadPoolExecutor(max_workers=min(len(paths), os.cpu_count() or 4)) as pool:
+        return dict(zip(paths, pool.map(audio_duration, paths)))
+
+
+def cpu_count() -> int:
+    """CPUs this process may run on (respects taskset/cgroup affinity where the OS exposes it)"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _first_stream(file_path: Path, codec_type: str) -> Optional[dict]:
+    """First audio/video stream of a file, or None"""
+    for stream in _probe(file_path).get("streams", []):
+        if stream.get("codec_type") == codec_type:
+            return stream
+    return None
+
+
+def _concat_signature(file_path: Path) -> tuple:
+    """Stream parameters that must match for the concat demuxer to stream-copy"""
+    v = _first_stream(file_path, "video") or {}
+    a = _first_stream(file_path, "audio") or {}
+    return (
+        v.get("codec_name"), v.get("width"), v.get("height"),
+        v.get("time_base"), v.get("pix_fmt"),
+        a.get("codec_name"), a.get("sample_rate"), a.get("channels"),
+    )
+
+
+@dataclass
+class Segment:
+    """One scene for assemble_segments: a video clip or still image plus its narration"""
+    audio: Path
+    video: Optional[Path] = None
+    image: Optional[Path] = None
+    max_duration: Optional[float] = None  # Still images only run as long as the narration, capped here
+
+
+def _copied_packets(container, src, dst, limit: float):
+    """Yield src's packets retargeted to dst, stopping at limit seconds"""
+    for packet in container.demux(src):
+        if packet.dts is None:  # Demuxer flush packet
+            continue
+        if packet.pts is not None and packet.pts * src.time_base >= limit:
+            break
+        packet.stream = dst
+        yield packet
+
+
+def _encoded_packets(container, src, dst, limit: float):
+    """Decode src, re-encode it with dst's codec and yield the packets, stopping at limit seconds"""
+    for frame in container.decode(src):
+        if frame.time is not None and frame.time >= limit:
+            break
+        yield from dst.encode(frame)
+    yield from dst.encode(None)  # Flush the encoder
 
 
 class FFmpegService:
     """Video composition using FFmpeg"""
     
-    def __init__(self):
+    def __init__(
+        self,
+        encoder: str = VIDEO_ENCODER,
+        on_progress: Optional[Callable[[str, float], None]] = None,
+        threads: int = 0
+    ):
+        """
+        Args:
+            encoder: auto, nvenc, qsv, videotoolbox, amf, or libx264
+            on_progress: Called with (description, fraction done) while encodes of known length run
+            threads: Encoder and filtergraph threads per ffmpeg process (0 lets ffmpeg use every core)
+        """
+        self.on_progress = on_progress
         self.available = self._check_ffmpeg()
+        self.vcodec = self._select_encoder(encoder)
+        self.vcodec_args = ENCODER_ARGS[self.vcodec]
+        
+        # ffmpeg sizes its thread pools to the whole machine, so parallel encodes oversubscribe without a cap
+        self._global_args = []
+        if threads > 0:
+            self._global_args = ["-filter_threads", str(threads), "-filter_complex_threads", str(threads)]
+            if self.vcodec == "libx264":
+                self.vcodec_args = self.vcodec_args + ["-threads", str(threads)]
+    
+    def _select_encoder(self, encoder: str) -> str:
+        """Resolve auto/nvenc/qsv/videotoolbox/amf/libx264 to the H.264 encoder to use"""
+        if encoder == "libx264" or not self.available:
+            return "libx264"
+        candidates = HW_ENCODERS if encoder == "auto" else [f"h264_{encoder}"]
+        for name in candidates:
+            if name in ENCODER_ARGS and _encoder_works(name):
+                print(f"🚀 Using {name} hardware encoder")
+                return name
+        if encoder != "auto":
+            print(f"⚠️ Encoder '{encoder}' requested but not usable, falling back to libx264")
+        return "libx264"
+    
+    def _audio_codec_args(self, audio_path: Path) -> List[str]:
+        """Copy AAC audio as-is, encode anything else to AAC"""
+        stream = _first_stream(audio_path, "audio")
+        if stream and stream.get("codec_name") == "aac":
+            return ["-c:a", "copy"]
+        return ["-c:a", "aac", "-b:a", "192k"]
+    
+    def _can_mux_in_process(self, audio_path: Path) -> bool:
+        """PyAV is installed and the narration has an audio stream for it to read"""
+        return av is not None and _first_stream(audio_path, "audio") is not None
+    
+    def _mux_copy(self, video_path: Path, audio_path: Path, output_path: Path) -> bool:
+        """
+        Mux the first video and audio streams into output_path with PyAV.
+        
+        Video packets are copied untouched. Audio is copied when it is
+        already AAC in an MP4-family container and encoded to AAC otherwise,
+        matching _audio_codec_args. Both streams are cut at the shorter one,
+        like `ffmpeg -shortest`, and written interleaved by timestamp.
+        Returns False on any libav error so the caller can fall back to the
+        ffmpeg CLI.
+        """
+        limit = min(probe_duration(video_path), audio_duration(audio_path))
+        try:
+            with av.open(str(video_path)) as v_in, av.open(str(audio_path)) as a_in, \
+                    av.open(str(output_path), "w") as out:
+                # PyAV 14 replaced add_stream(template=...) with add_stream_from_template
+                from_template = getattr(out, "add_stream_from_template", None) \
+                    or (lambda src: out.add_stream(template=src))
+                v_src, a_src = v_in.streams.video[0], a_in.streams.audio[0]
+                video = _copied_packets(v_in, v_src, from_template(v_src), limit)
+                
+                if a_src.codec_context.name == "aac" and "mp4" in a_in.format.name:
+                    audio = _copied_packets(a_in, a_src, from_template(a_src), limit)
+                else:
+                    a_dst = out.add_stream("aac", rate=a_src.rate)
+                    a_dst.layout = a_src.layout.name
+                    a_dst.bit_rate = 192000
+                    audio = _encoded_packets(a_in, a_src, a_dst, limit)
+                
+                # Merging by dts keeps the streams interleaved, so the muxer never buffers a whole stream
+                for packet in heapq.merge(video, audio, key=lambda p: p.dts * p.time_base):
+                    out.mux(packet)
+            return True
+        except Exception as e:
+            print(f"⚠️ In-process mux failed ({e}), using ffmpeg")
+            output_path.unlink(missing_ok=True)
+            return False
     
     def _check_ffmpeg(self) -> bool:
         """Check if FFmpeg is installed"""
-        return shutil.which("ffmpeg") is not None
+        return _FFMPEG_PATH is not None
     
-    def _run_ffmpeg(self, args: List[str], description: str = "Processing") -> bool:
-        """Run FFmpeg command"""
-        cmd = ["ffmpeg", "-y"] + args  # -y to overwrite
+    def _run_ffmpeg(
+        self,
+        args: List[str],
+        description: str = "Processing",
+        duration: Optional[float] = None
+    ) -> bool:
+        """
+        Run FFmpeg command.
+        
+        stderr is read as it is produced: -progress key=value lines drive
+        on_progress, and only the last 50 log lines are kept for errors.
+        
+        Args:
+            args: Arguments after `ffmpeg -y`
+            description: Log label
+            duration: Expected output length in seconds, for progress fractions
+        """
+        cmd = [_FFMPEG_PATH or "ffmpeg", "-y", "-nostats", "-progress", "pipe:2", *self._global_args] + args  # -y to overwrite
         
         print(f"🔧 {description}...")
         
-        try:
-            result = subprocess.run(
+        # Also bounds encodes started outside the assembler's pool (several assemblers, the fused path)
+        with _ffmpeg_slots:
+            proc = subprocess.Popen(
                 cmd,
-                capture_output=True,
-                timeout=300
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                text=True,
+                errors="replace"
             )
             
-            if result.returncode != 0:
-                error = result.stderr.decode()
-                print(f"❌ FFmpeg error: {error[-500:]}")  # Last 500 chars
-                return False
+            timed_out = threading.Event()
             
-            return True
+            def kill():
+                timed_out.set()
+                proc.kill()
             
-        except subprocess.TimeoutExpired:
+            tail = deque(maxlen=50)
+            timer = threading.Timer(FFMPEG_TIMEOUT, kill)
+            timer.start()
+            try:
+                for line in proc.stderr:
+                    line = line.rstrip()
+                    key, sep, value = line.partition("=")
+                    if sep and key == "out_time_us":
+                        if self.on_progress and duration and value.isdigit():
+                            self.on_progress(description, min(int(value) / (duration * 1e6), 1.0))
+                    elif sep and " " not in key:
+                        continue  # Other -progress fields (frame=, fps=, speed=, ...)
+                    elif line:
+                        tail.append(line)
+                proc.wait()
+            finally:
+                timer.cancel()
+                proc.stderr.close()
+        
+        if timed_out.is_set():
             print("❌ FFmpeg timed out")
             return False
+        
+        if proc.returncode != 0:
+            error = "\n".join(tail)
+            print(f"❌ FFmpeg error: {error[-500:]}")  # Last 500 chars
+            return False
+        
+        return True
     
     def combine_video_audio(
         self,
@@ -69,12 +439,14 @@ class FFmpegService:
         output_path = Path(output_path)
         output_path.parent.mkdir(parents=True, exist_ok=True)
         
+        if self._can_mux_in_process(audio_path) and self._mux_copy(video_path, audio_path, output_path):
+            return output_path
+        
         args = [
             "-i", str(video_path),
             "-i", str(audio_path),
             "-c:v", "copy",
-            "-c:a", "aac",
-            "-b:a", "192k",
+            *self._audio_codec_args(audio_path),
             "-shortest",  # End when shortest stream ends
             str(output_path)
         ]
@@ -106,32 +478,190 @@ class FFmpegService:
         output_path = Path(output_path)
         output_path.parent.mkdir(parents=True, exist_ok=True)
         
-        if zoom_effect:
-            # Slow zoom in effect
-            filter_complex = (
-                f"scale=8000:-1,"
-                f"zoompan=z='min(zoom+0.0015,1.5)':x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)':"
-                f"d={int(duration * VIDEO_FPS)}:s={VIDEO_WIDTH}x{VIDEO_HEIGHT}:fps={VIDEO_FPS}"
-            )
-        else:
-            filter_complex = f"scale={VIDEO_WIDTH}:{VIDEO_HEIGHT}:force_original_aspect_ratio=decrease,pad={VIDEO_WIDTH}:{VIDEO_HEIGHT}:(ow-iw)/2:(oh-ih)/2"
+        filter_complex = self._image_filter(duration, zoom_effect)
         
         args = [
             "-loop", "1",
             "-i", str(image_path),
             "-vf", filter_complex,
-            "-c:v", "libx264",
+            *self.vcodec_args,
             "-t", str(duration),
             "-pix_fmt", "yuv420p",
             "-r", str(VIDEO_FPS),
             str(output_path)
         ]
         
-        if self._run_ffmpeg(args, f"Converting {image_path.name} to video"):
+        if self._run_ffmpeg(args, f"Converting {image_path.name} to video", duration=duration):
             return output_path
         else:
             raise RuntimeError("Failed to convert image to video")
     
+    def build_segment(
+        self,
+        image_path: Path,
+        audio_path: Path,
+        output_path: Path,
+        max_duration: Optional[float] = None,
+        zoom_effect: bool = True,
+        audio_fade_out: float = 0.5
+    ) -> Path:
+        """
+        Render a still image with its narration in a single ffmpeg pass.
+        
+        Equivalent to image_to_video followed by add_audio_to_video, but the
+        frames are encoded once and never written to an intermediate file.
+        
+        Args:
+            image_path: Input image
+            audio_path: Narration audio
+            output_path: Output video
+            max_duration: Cut the segment at this length (default: full narration)
+            zoom_effect: Apply slow zoom (Ken Burns effect)
+            audio_fade_out: Fade out duration at end of the narration
+            
+        Returns:
+            Path to output video
+        """
+        output_path = Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        duration = audio_duration(audio_path)
+        if max_duration is not None:
+            duration = min(duration, max_duration)
+        fade_start = max(duration - audio_fade_out, 0)
+        
+        filter_complex = (
+            f"[0:v]{self._image_filter(duration, zoom_effect)},format=yuv420p[v];"
+            f"[1:a]afade=t=out:st={fade_start:.3f}:d={audio_fade_out}[a]"
+        )
+        
+        args = [
+            "-loop", "1",
+            "-i", str(image_path),
+            "-i", str(audio_path),
+            "-filter_complex", filter_complex,
+            "-map", "[v]",
+            "-map", "[a]",
+            *self.vcodec_args,
+            "-c:a", "aac",
+            "-b:a", "192k",
+            "-t", f"{duration:.3f}",
+            "-r", str(VIDEO_FPS),
+            str(output_path)
+        ]
+        
+        if self._run_ffmpeg(args, f"Rendering {image_path.name} + {Path(audio_path).name}", duration=duration):
+            return output_path
+        else:
+            raise RuntimeError("Failed to render segment")
+    
+    def _image_filter(self, duration: float, zoom_effect: bool) -> str:
+        """Filter chain turning a looped still image into output-sized frames"""
+        if zoom_effect:
+            # Slow zoom in effect. zoompan crops on integer pixels, so work on a 2x
+            # canvas (enough headroom for the 1.5x max zoom) to keep the motion smooth
+            # without pushing ~8000px-wide frames through the filter
+            return (
+                f"scale={VIDEO_WIDTH * 2}:{VIDEO_HEIGHT * 2}:force_original_aspect_ratio=increase:flags=lanczos,"
+                f"crop={VIDEO_WIDTH * 2}:{VIDEO_HEIGHT * 2},"
+                f"zoompan=z='min(zoom+0.0015,1.5)':x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)':"
+                f"d={int(duration * VIDEO_FPS)}:s={VIDEO_WIDTH}x{VIDEO_HEIGHT}:fps={VIDEO_FPS}"
+            )
+        return f"scale={VIDEO_WIDTH}:{VIDEO_HEIGHT}:force_original_aspect_ratio=decrease,pad={VIDEO_WIDTH}:{VIDEO_HEIGHT}:(ow-iw)/2:(oh-ih)/2"
+    
+    def assemble_segments(
+        self,
+        segments: List[Segment],
+        output_path: Path,
+        music_path: Optional[Path] = None,
+        music_volume: float = 0.15,
+        fade_out: float = 2.0,
+        zoom_effect: bool = True
+    ) -> Path:
+        """
+        Render a whole video from its scenes in one ffmpeg invocation.
+        
+        Each segment is scaled (or zoompanned, for stills) and trimmed to its
+        narration, then everything is concatenated and mixed with the music
+        inside one filtergraph, so the video is encoded exactly once.
+        
+        Args:
+            segments: Scenes in order
+            output_path: Output video
+            music_path: Optional background music file
+            music_volume: Volume level for music (0.0-1.0)
+            fade_out: Music fade out duration at end
+            zoom_effect: Apply slow zoom (Ken Burns effect) to stills
+            
+        Returns:
+            Path to output video
+        """
+        output_path = Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        inputs = []
+        filters = []
+        concat_inputs = ""
+        total = 0.0
+        narration_lengths = audio_durations([seg.audio for seg in segments])
+        for i, seg in enumerate(segments):
+            duration = narration_lengths[seg.audio]
+            if seg.max_duration is not None:
+                duration = min(duration, seg.max_duration)
+            
+            if seg.video is not None:
+                # Same cut as add_audio_to_video's -shortest
+                duration = min(duration, probe_duration(seg.video))
+                inputs += ["-i", str(seg.video)]
+                video_chain = (
+                    f"scale={VIDEO_WIDTH}:{VIDEO_HEIGHT}:force_original_aspect_ratio=decrease,"
+                    f"pad={VIDEO_WIDTH}:{VIDEO_HEIGHT}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={VIDEO_FPS}"
+                )
+            else:
+                inputs += ["-loop", "1", "-t", f"{duration:.3f}", "-i", str(seg.image)]
+                video_chain = f"{self._image_filter(duration, zoom_effect)},setsar=1"
+            inputs += ["-i", str(seg.audio)]
+            
+            v, a = 2 * i, 2 * i + 1
+            filters.append(
+                f"[{v}:v]{video_chain},trim=duration={duration:.3f},setpts=PTS-STARTPTS,format=yuv420p[v{i}]"
+            )
+            filters.append(
+                f"[{a}:a]atrim=duration={duration:.3f},asetpts=PTS-STARTPTS,"
+                f"aresample=48000,aformat=channel_layouts=stereo[a{i}]"
+            )
+            concat_inputs += f"[v{i}][a{i}]"
+            total += duration
+        
+        filters.append(f"{concat_inputs}concat=n={len(segments)}:v=1:a=1[vout][narration]")
+        
+        audio_out = "[narration]"
+        if music_path is not None:
+            m = 2 * len(segments)
+            inputs += ["-i", str(music_path)]
+            filters.append(
+                f"[{m}:a]volume={music_volume},"
+                f"afade=t=out:st={max(total - fade_out, 0):.3f}:d={fade_out}[bgm]"
+            )
+            filters.append("[narration][bgm]amix=inputs=2:duration=first[aout]")
+            audio_out = "[aout]"
+        
+        args = inputs + [
+            "-filter_complex", ";".join(filters),
+            "-map", "[vout]",
+            "-map", audio_out,
+            *self.vcodec_args,
+            "-c:a", "aac",
+            "-b:a", "192k",
+            "-r", str(VIDEO_FPS),
+            str(output_path)
+        ]
+        
+        if self._run_ffmpeg(args, f"Rendering {len(segments)} scenes", duration=total):
+            return output_path
+        else:
+            raise RuntimeError("Failed to render video")
+    
     def concatenate_videos(
         self,
         video_paths: List[Path],
@@ -150,11 +680,12 @@ class FFmpegService:
         output_path = Path(output_path)
         output_path.parent.mkdir(parents=True, exist_ok=True)
         
-        # Create concat file
-        concat_file = output_path.parent / "concat_list.txt"
-        with open(concat_file, "w") as f:
-            for vp in video_paths:
-                f.write(f"file '{vp.absolute()}'\n")
+        # The concat demuxer only stream-copies cleanly when every segment shares codec parameters
+        if len({_concat_signature(vp) for vp in video_paths}) > 1:
+            print("⚠️ Segments differ in codec parameters, re-encoding concat")
+            return self._concatenate_reencode(video_paths, output_path)
+        
+        concat_file = self._write_concat_list(video_paths)
         
         args = [
             "-f", "concat",
@@ -172,6 +703,117 @@ class FFmpegService:
         finally:
             concat_file.unlink(missing_ok=True)
     
+    def concat_with_bgm(
+        self,
+        video_paths: List[Path],
+        music_path: Path,
+        output_path: Path,
+        music_volume: float = 0.15,
+        fade_out: float = 2.0
+    ) -> Path:
+        """
+        Concatenate videos and mix in background music in one pass.
+        
+        Video packets are stream-copied through the concat demuxer; only the
+        audio is re-encoded, so the joined file is never written twice.
+        
+        Args:
+            video_paths: List of video files to concatenate
+            music_path: Background music file
+            output_path: Output video
+            music_volume: Volume level for music (0.0-1.0)
+            fade_out: Fade out duration at end
+            
+        Returns:
+            Path to output file
+        """
+        output_path = Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        # Mismatched segments need the re-encoding concat anyway, so mix the music afterwards
+        if len({_concat_signature(vp) for vp in video_paths}) > 1:
+            combined = output_path.with_name(f"{output_path.stem}_concat{output_path.suffix}")
+            self.concatenate_videos(video_paths, combined)
+            try:
+                return self.add_background_music(combined, music_path, output_path, music_volume, fade_out)
+            finally:
+                combined.unlink(missing_ok=True)
+        
+        total = sum(probe_duration(vp) for vp in video_paths)
+        concat_file = self._write_concat_list(video_paths)
+        
+        filter_complex = (
+            f"[1:a]volume={music_volume},"
+            f"afade=t=out:st={max(total - fade_out, 0):.3f}:d={fade_out}[bgm];"
+            f"[0:a][bgm]amix=inputs=2:duration=first[aout]"
+        )
+        
+        args = [
+            "-f", "concat",
+            "-safe", "0",
+            "-i", str(concat_file),
+            "-i", str(music_path),
+            "-filter_complex", filter_complex,
+            "-map", "0:v",
+            "-map", "[aout]",
+            "-c:v", "copy",
+            "-c:a", "aac",
+            "-b:a", "192k",
+            str(output_path)
+        ]
+        
+        try:
+            if self._run_ffmpeg(args, f"Concatenating {len(video_paths)} videos with music", duration=total):
+                return output_path
+            else:
+                raise RuntimeError("Failed to concatenate videos with music")
+        finally:
+            concat_file.unlink(missing_ok=True)
+    
+    def _write_concat_list(self, video_paths: List[Path]) -> Path:
+        """Write a concat demuxer list file; the caller deletes it"""
+        # Concat list goes to the temp dir, not the (possibly shared) output directory
+        content = "".join(f"file '{Path(vp).absolute()}'\n" for vp in video_paths)
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+            f.write(content)
+        return Path(f.name)
+    
+    def _concatenate_reencode(self, video_paths: List[Path], output_path: Path) -> Path:
+        """Concatenate mismatched segments with the concat filter, normalizing each to the output format"""
+        has_audio = all(_first_stream(vp, "audio") for vp in video_paths)
+        
+        inputs = []
+        filters = []
+        concat_inputs = ""
+        for i, vp in enumerate(video_paths):
+            inputs += ["-i", str(vp)]
+            filters.append(
+                f"[{i}:v]scale={VIDEO_WIDTH}:{VIDEO_HEIGHT}:force_original_aspect_ratio=decrease,"
+                f"pad={VIDEO_WIDTH}:{VIDEO_HEIGHT}:(ow-iw)/2:(oh-ih)/2,setsar=1,"
+                f"fps={VIDEO_FPS},format=yuv420p[v{i}]"
+            )
+            concat_inputs += f"[v{i}]"
+            if has_audio:
+                filters.append(f"[{i}:a]aresample=48000,aformat=channel_layouts=stereo[a{i}]")
+                concat_inputs += f"[a{i}]"
+        
+        outputs = "[vout][aout]" if has_audio else "[vout]"
+        filters.append(f"{concat_inputs}concat=n={len(video_paths)}:v=1:a={int(has_audio)}{outputs}")
+        
+        args = inputs + [
+            "-filter_complex", ";".join(filters),
+            "-map", "[vout]",
+            *self.vcodec_args,
+        ]
+        if has_audio:
+            args += ["-map", "[aout]", "-c:a", "aac", "-b:a", "192k"]
+        args.append(str(output_path))
+        
+        if self._run_ffmpeg(args, f"Re-encoding {len(video_paths)} videos into one"):
+            return output_path
+        else:
+            raise RuntimeError("Failed to concatenate videos")
+    
     def add_background_music(
         self,
         video_path: Path,
@@ -227,11 +869,14 @@ class FFmpegService:
         output_path = Path(output_path)
         output_path.parent.mkdir(parents=True, exist_ok=True)
         
+        if self._can_mux_in_process(audio_path) and self._mux_copy(video_path, audio_path, output_path):
+            return output_path
+        
         args = [
             "-i", str(video_path),
             "-i", str(audio_path),
             "-c:v", "copy",
-            "-c:a", "aac",
+            *self._audio_codec_args(audio_path),
             "-map", "0:v:0",
             "-map", "1:a:0",
             "-shortest",
@@ -245,13 +890,4 @@ class FFmpegService:
     
     def get_duration(self, file_path: Path) -> float:
         """Get duration of video/audio file"""
-        cmd = [
-            "ffprobe",
-            "-v", "error",
-            "-show_entries", "format=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1",
-            str(file_path)
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        return float(result.stdout.strip())
+        return probe_duration(file_path)
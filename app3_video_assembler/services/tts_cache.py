@@ -0,0 +1,121 @@
+"""
+TTS Cache
+Content-addressed narration clips on disk, so re-rendering a story only
+synthesizes the lines that changed.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from typing import Optional
+
+from shared.config import TTS_CACHE_DIR, TTS_CACHE_MB
+
+# Shared by every TTSCache so parallel assemblies don't evict over each other
+_evict_lock = threading.Lock()
+
+
+def _copy_atomic(src: Path, dst: Path):
+    """
+    Copy src to dst through a temp file and a rename.
+
+    Clips are copied rather than hardlinked: TTS engines rewrite their
+    output path in place, which would otherwise change the cache entry
+    sharing its inode. The rename also gives dst a fresh inode each time.
+    The temp name is unique, so concurrent copies to the same dst don't
+    write into each other's file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=dst.parent, prefix=f".{dst.name}.", suffix=".tmp")
+    os.close(fd)
+    tmp = Path(tmp)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+class TTSCache:
+    """Narration clips keyed by (engine settings, text), evicted least recently used first"""
+
+    def __init__(self, cache_dir: Path = TTS_CACHE_DIR, max_mb: int = TTS_CACHE_MB):
+        """
+        Initialize the cache.
+
+        Args:
+            cache_dir: Directory holding cached clips
+            max_mb: Size cap in megabytes (0 disables the cache)
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.enabled = max_mb > 0
+
+        if self.enabled:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(tag: str, text: str) -> str:
+        """Cache key for an utterance; tag identifies the engine, model and voice"""
+        return hashlib.blake2b(f"{tag}\0{text}".encode(), digest_size=16).hexdigest()
+
+    def fetch(self, key: str, output_path: Path) -> Optional[Path]:
+        """
+        Place a cached clip at output_path (its extension follows the cached file).
+
+        Returns:
+            The clip's path, or None on a miss
+        """
+        if not self.enabled:
+            return None
+
+        # Skip temp files from a store still in progress
+        cached = next((p for p in self.cache_dir.glob(f"{key}.*") if p.suffix != ".tmp"), None)
+        if cached is None:
+            return None
+
+        output_path = Path(output_path).with_suffix(cached.suffix)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            _copy_atomic(cached, output_path)
+            os.utime(cached)  # Mark as recently used
+        except FileNotFoundError:
+            return None  # Evicted in the meantime
+        return output_path
+
+    def store(self, key: str, audio_path: Path):
+        """Add a freshly synthesized clip, then trim the cache back under its size cap"""
+        if not self.enabled:
+            return
+
+        audio_path = Path(audio_path)
+        target = self.cache_dir / f"{key}{audio_path.suffix}"
+        try:
+            _copy_atomic(audio_path, target)
+        except OSError as e:
+            print(f"⚠️ Could not cache {audio_path.name}: {e}")
+            return
+
+        self._evict()
+
+    def _evict(self):
+        """Delete least recently used clips until the cache fits in max_bytes"""
+        with _evict_lock:
+            entries = []
+            for path in self.cache_dir.iterdir():
+                if path.suffix == ".tmp":
+                    continue
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
@@ -7,13 +7,26 @@ Text-to-speech with multiple backends:
 
 import subprocess
 import asyncio
+import copy
+import functools
 import os
+import shutil
 import sys
+import tempfile
+import threading
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
-sys.path.insert(0, str(Path(__file__).parent.parent.parent))
-from shared.config import VIBEVOICE_MODEL, VIBEVOICE_SPEAKER, VIBEVOICE_REPO_PATH
+from shared.config import (
+    VIBEVOICE_MODEL, VIBEVOICE_SPEAKER, VIBEVOICE_REPO_PATH, VIBEVOICE_DDPM_STEPS,
+    VIBEVOICE_QUANT, VIBEVOICE_COMPILE
+)
+from .ffmpeg_service import audio_duration, audio_durations
+
+try:
+    import edge_tts
+except ImportError:  # Checked by EdgeTTSService.available
+    edge_tts = None
 
 
 class EdgeTTSService:
@@ -29,12 +42,14 @@ class EdgeTTSService:
         self.available = self._check_available()
     
     def _check_available(self) -> bool:
-        try:
-            import edge_tts
-            return True
-        except ImportError:
+        if edge_tts is None:
             print("⚠️ edge-tts not installed. Install with: pip install edge-tts")
             return False
+        return True
+    
+    def cache_tag(self, voice: Optional[str] = None) -> str:
+        """Identifies everything besides the text that shapes the audio"""
+        return f"edge|{voice or self.voice}"
     
     def synthesize(self, text: str, output_path: Path, voice: Optional[str] = None) -> Path:
         if not self.available:
@@ -50,7 +65,6 @@ class EdgeTTSService:
         print(f"   Text: {text[:50]}...")
         
         async def generate():
-            import edge_tts
             communicate = edge_tts.Communicate(text, voice)
             await communicate.save(str(output_path))
         
@@ -59,13 +73,72 @@ class EdgeTTSService:
         print(f"✅ Audio saved: {output_path}")
         return output_path
     
+    def synthesize_many(
+        self,
+        texts: List[str],
+        output_paths: List[Path],
+        voice: Optional[str] = None,
+        max_concurrent: int = 4
+    ) -> List[Optional[Path]]:
+        """
+        Synthesize several utterances concurrently on one event loop.
+        
+        Each request spends most of its time waiting on the network, so
+        overlapping them costs about as long as the slowest one.
+        
+        Args:
+            texts: Utterances to speak
+            output_paths: Output file per utterance (extension replaced with .mp3)
+            voice: Voice override
+            max_concurrent: Requests in flight at once
+            
+        Returns:
+            Audio paths in input order (None where synthesis failed)
+        """
+        if not self.available:
+            raise RuntimeError("edge-tts not installed")
+        
+        voice = voice or self.voice
+        paths = [Path(p).with_suffix(".mp3") for p in output_paths]
+        for path in paths:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        
+        print(f"🔊 Generating {len(texts)} clips with Edge-TTS...")
+        print(f"   Voice: {voice}")
+        
+        async def generate_all():
+            slots = asyncio.Semaphore(max_concurrent)
+            
+            async def generate(text: str, path: Path) -> Path:
+                async with slots:
+                    await edge_tts.Communicate(text, voice).save(str(path))
+                return path
+            
+            return await asyncio.gather(
+                *(generate(text, path) for text, path in zip(texts, paths)),
+                return_exceptions=True
+            )
+        
+        results = []
+        for path, result in zip(paths, asyncio.run(generate_all())):
+            if isinstance(result, BaseException):
+                print(f"⚠️ TTS failed for {path}: {result}")
+                results.append(None)
+            else:
+                results.append(result)
+        
+        print(f"✅ Audio saved: {sum(r is not None for r in results)}/{len(results)} clips")
+        return results
+    
     def get_audio_duration(self, audio_path: Path) -> float:
-        result = subprocess.run(
-            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
-             "-of", "default=noprint_wrappers=1:nokey=1", str(audio_path)],
-            capture_output=True, text=True
-        )
-        return float(result.stdout.strip())
+        return audio_duration(audio_path)
+    
+    def get_audio_durations(self, audio_paths: List[Path]) -> dict:
+        return audio_durations(audio_paths)
+
+
+# Installation check results by repo path; checking imports the package (and used to pip install)
+_vibevoice_available: dict[Path, bool] = {}
 
 
 class VibeVoiceTTSService:
@@ -77,15 +150,185 @@ class VibeVoiceTTSService:
         self,
         repo_path: str = VIBEVOICE_REPO_PATH,
         model_id: str = VIBEVOICE_MODEL,
-        speaker: str = VIBEVOICE_SPEAKER
+        speaker: str = VIBEVOICE_SPEAKER,
+        quant: str = VIBEVOICE_QUANT,
+        compile: bool = VIBEVOICE_COMPILE
     ):
         self.repo_path = Path(repo_path)
         self.model_id = model_id
         self.speaker = speaker
+        self.quant = quant
+        self.compile = compile
         self.available = self._check_installation()
+        
+        # Demo-script fallback invocation, resolved once
+        self._inference_script = str(self.repo_path / "demo" / "realtime_model_inference_from_file.py")
+        self._cwd = str(self.repo_path)
+        self._env = {**os.environ, "PYTHONPATH": f"{self.repo_path}:{os.environ.get('PYTHONPATH', '')}"}
+        
+        # Resident model, loaded on first use
+        self.model = None
+        self.processor = None
+        self.device = None
+        self._voice_prompts = {}
+        self._in_process = True  # Cleared if the Python API can't be loaded; synthesize then runs the demo script
+        
+        # TTSFactory shares one service per process, so assemblies in parallel threads take turns on the GPU
+        self._gpu_lock = threading.Lock()
+    
+    def load_model(self) -> bool:
+        """
+        Load the streaming model and processor once for all synthesize calls.
+        
+        Returns:
+            False if the VibeVoice Python API is unusable
+        """
+        if self.model is not None:
+            return True
+        if not self._in_process:
+            return False
+        
+        try:
+            import torch
+            from vibevoice.modular.modeling_vibevoice_streaming_inference import (
+                VibeVoiceStreamingForConditionalGenerationInference
+            )
+            from vibevoice.processor.vibevoice_streaming_processor import VibeVoiceStreamingProcessor
+            
+            print(f"📦 Loading VibeVoice: {self.model_id}")
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            self.processor = VibeVoiceStreamingProcessor.from_pretrained(self.model_id)
+            
+            load_kwargs = {
+                "torch_dtype": torch.bfloat16 if self.device == "cuda" else torch.float32,
+                "device_map": self.device,
+            }
+            quantization_config = self._quantization_config()
+            if quantization_config is not None:
+                load_kwargs["quantization_config"] = quantization_config
+            try:
+                if self.device != "cuda":
+                    raise ImportError("flash-attn needs CUDA")
+                self.model = VibeVoiceStreamingForConditionalGenerationInference.from_pretrained(
+                    self.model_id, attn_implementation="flash_attention_2", **load_kwargs
+                )
+            except (ImportError, ValueError) as e:
+                # transformers raises ImportError/ValueError when flash-attn is missing or unsupported
+                print(f"   Flash attention unavailable ({e}), using SDPA")
+                self.model = VibeVoiceStreamingForConditionalGenerationInference.from_pretrained(
+                    self.model_id, attn_implementation="sdpa", **load_kwargs
+                )
+            self.model.eval()
+            self.model.set_ddpm_inference_steps(num_steps=VIBEVOICE_DDPM_STEPS)
+            if self.compile and self.device == "cuda":
+                self._compile_prediction_head()
+            print("✅ VibeVoice loaded")
+            return True
+        except Exception as e:
+            print(f"⚠️ VibeVoice Python API unavailable ({e}), using the demo script")
+            self._in_process = False
+            self.model = None
+            self.processor = None
+            return False
+    
+    def _compile_prediction_head(self):
+        """Compile the diffusion head in place; the LM is left eager"""
+        # The LM's KV cache grows every step, so CUDA graphs would re-record constantly.
+        # The head runs DDPM_STEPS times per latent at a fixed shape, which graphs replay well.
+        head = getattr(getattr(self.model, "model", None), "prediction_head", None)
+        if head is None:
+            print("   No prediction head found, skipping torch.compile")
+            return
+        try:
+            print("   Compiling diffusion head (reduce-overhead, first utterance pays for it)...")
+            head.compile(mode="reduce-overhead", fullgraph=False)
+        except Exception as e:
+            print(f"⚠️ torch.compile skipped: {e}")
+    
+    def _quantization_config(self):
+        """Build the bitsandbytes config for self.quant (None for bf16)"""
+        if self.quant in ("", "none") or self.device != "cuda":
+            return None
+        
+        try:
+            import bitsandbytes  # noqa: F401
+            from transformers import BitsAndBytesConfig
+        except ImportError:
+            print(f"⚠️ bitsandbytes not installed, loading without {self.quant} quantization")
+            return None
+        
+        if self.quant == "int8":
+            print("   Quantizing LM weights to INT8...")
+            # Only the language model; the diffusion head and acoustic modules are small and quality-sensitive
+            return BitsAndBytesConfig(
+                load_in_8bit=True,
+                llm_int8_skip_modules=["prediction_head", "acoustic_tokenizer", "acoustic_connector"]
+            )
+        
+        print(f"⚠️ Unknown quantization '{self.quant}', loading bf16")
+        return None
+    
+    def unload_model(self):
+        """Free the resident model"""
+        with self._gpu_lock:
+            if self.model is None:
+                return
+            import torch
+            self.model = None
+            self.processor = None
+            self._voice_prompts.clear()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            print("🗑️ VibeVoice unloaded")
+    
+    def _voice_prompt(self, speaker: str):
+        """Prefilled voice preset for a speaker (demo/voices/streaming_model/*.pt), cached"""
+        if speaker not in self._voice_prompts:
+            import torch
+            voices_dir = self.repo_path / "demo" / "voices" / "streaming_model"
+            matches = sorted(p for p in voices_dir.glob("*.pt") if speaker.lower() in p.stem.lower())
+            if not matches:
+                raise RuntimeError(f"No VibeVoice voice preset for '{speaker}' in {voices_dir}")
+            self._voice_prompts[speaker] = torch.load(matches[0], map_location=self.device, weights_only=False)
+        return self._voice_prompts[speaker]
+    
+    def _synthesize_in_process(self, text: str, output_path: Path, speaker: str):
+        """Generate speech with the resident model"""
+        import torch
+        
+        prompt = self._voice_prompt(speaker)
+        script = text.replace("’", "'").replace("“", '"').replace("”", '"')
+        
+        inputs = self.processor.process_input_with_cached_prompt(
+            text=script,
+            cached_prompt=prompt,
+            padding=True,
+            return_tensors="pt",
+            return_attention_mask=True
+        )
+        inputs = {k: v.to(self.device) if torch.is_tensor(v) else v for k, v in inputs.items()}
+        
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=None,
+                cfg_scale=1.5,
+                tokenizer=self.processor.tokenizer,
+                generation_config={"do_sample": False},
+                verbose=False,
+                # generate mutates the prefilled cache, so hand it a copy
+                all_prefilled_outputs=copy.deepcopy(prompt)
+            )
+        
+        self.processor.save_audio(outputs.speech_outputs[0], output_path=str(output_path))
     
     def _check_installation(self) -> bool:
-        """Check if VibeVoice is properly installed"""
+        """Check if VibeVoice is properly installed (once per repo path per process)"""
+        if self.repo_path not in _vibevoice_available:
+            _vibevoice_available[self.repo_path] = self._probe_installation()
+        return _vibevoice_available[self.repo_path]
+    
+    def _probe_installation(self) -> bool:
         if not self.repo_path.exists():
             print(f"⚠️ VibeVoice repo not found at {self.repo_path}")
             print("   Clone with: git clone https://github.com/microsoft/VibeVoice.git models/VibeVoice")
@@ -102,43 +345,82 @@ class VibeVoiceTTSService:
         try:
             # Add repo to path temporarily to check
             sys.path.insert(0, str(self.repo_path))
-            import vibevoice
-            sys.path.pop(0)
+            try:
+                import vibevoice
+            finally:
+                sys.path.remove(str(self.repo_path))
             print(f"✅ VibeVoice ready")
             return True
         except ImportError:
-            # Try installing it
-            print("⚠️ VibeVoice module not installed. Attempting to install...")
-            try:
-                result = subprocess.run(
-                    [sys.executable, "-m", "pip", "install", "-e", "."],
-                    cwd=str(self.repo_path),
-                    capture_output=True,
-                    text=True,
-                    timeout=120
-                )
-                if result.returncode == 0:
-                    print("✅ VibeVoice installed successfully")
-                    return True
-                else:
-                    print(f"⚠️ VibeVoice install failed: {result.stderr[:200]}")
-                    return False
-            except Exception as e:
-                print(f"⚠️ Could not install VibeVoice: {e}")
-                return False
+            print("⚠️ VibeVoice module not installed")
+            print(f"   Install with: cd {self.repo_path} && pip install -e .  (or ./start.sh setup)")
+            return False
+    
+    @classmethod
+    def ensure_installed(cls, repo_path: str = VIBEVOICE_REPO_PATH) -> bool:
+        """
+        pip install the VibeVoice repo in editable mode (one-time setup, not done at runtime).
+        
+        Returns:
+            True if the install succeeded
+        """
+        repo_path = Path(repo_path)
+        try:
+            result = subprocess.run(
+                [sys.executable, "-m", "pip", "install", "-e", "."],
+                cwd=str(repo_path),
+                capture_output=True,
+                text=True,
+                timeout=120
+            )
+        except Exception as e:
+            print(f"⚠️ Could not install VibeVoice: {e}")
+            return False
+        
+        if result.returncode != 0:
+            print(f"⚠️ VibeVoice install failed: {result.stderr[:200]}")
+            return False
+        
+        print("✅ VibeVoice installed successfully")
+        _vibevoice_available.pop(repo_path, None)  # Re-check on next construction
+        return True
+    
+    def cache_tag(self, speaker: Optional[str] = None) -> str:
+        """Identifies everything besides the text that shapes the audio"""
+        return f"vibevoice|{self.model_id}|{speaker or self.speaker}|{VIBEVOICE_DDPM_STEPS}|{self.quant}"
     
     def synthesize(self, text: str, output_path: Path, speaker: Optional[str] = None) -> Path:
-        """Generate speech using VibeVoice"""
+        """Generate speech using VibeVoice (thread-safe; calls run one at a time)"""
         if not self.available:
             raise RuntimeError("VibeVoice not available")
         
+        # Neither the resident model nor a second demo-script model fits alongside a running one
+        with self._gpu_lock:
+            return self._synthesize(text, output_path, speaker)
+    
+    def _synthesize(self, text: str, output_path: Path, speaker: Optional[str]) -> Path:
+        """Generate speech using VibeVoice; caller holds _gpu_lock"""
         speaker = speaker or self.speaker
         output_path = Path(output_path).with_suffix(".wav")
         output_path.parent.mkdir(parents=True, exist_ok=True)
         
-        # Write text to temp file
-        temp_txt = output_path.parent / "temp_input.txt"
-        temp_txt.write_text(text)
+        if self.load_model():
+            print(f"🔊 Generating speech with VibeVoice...")
+            print(f"   Speaker: {speaker}")
+            print(f"   Text: {text[:50]}...")
+            
+            self._synthesize_in_process(text, output_path, speaker)
+            
+            print(f"✅ Audio saved: {output_path}")
+            return output_path
+        
+        # Fallback: one demo-script process per utterance (reloads the model every time)
+        # Each call gets its own scratch dir next to the output, so concurrent calls can't
+        # clobber each other and the script's output name is known up front
+        work_dir = Path(tempfile.mkdtemp(prefix="vv_", dir=output_path.parent))
+        temp_txt = work_dir / "input.txt"
+        temp_txt.write_text(text, encoding="utf-8")
+        generated = work_dir / f"{temp_txt.stem}_generated.wav"
         
         print(f"🔊 Generating speech with VibeVoice...")
         print(f"   Speaker: {speaker}")
@@ -147,21 +429,18 @@ class VibeVoiceTTSService:
         # Build command
         cmd = [
             sys.executable,
-            str(self.repo_path / "demo" / "realtime_model_inference_from_file.py"),
+            self._inference_script,
             "--model_path", self.model_id,
             "--txt_path", str(temp_txt),
             "--speaker_name", speaker,
-            "--output_path", str(output_path)
+            "--output_dir", str(work_dir)
         ]
         
-        env = os.environ.copy()
-        env["PYTHONPATH"] = str(self.repo_path) + ":" + env.get("PYTHONPATH", "")
-        
         try:
             result = subprocess.run(
                 cmd,
-                cwd=str(self.repo_path),
-                env=env,
+                cwd=self._cwd,
+                env=self._env,
                 capture_output=True,
                 text=True,
                 timeout=180
@@ -171,29 +450,53 @@ class VibeVoiceTTSService:
                 print(f"❌ VibeVoice error:\n{result.stderr[-500:]}")
                 raise RuntimeError(f"VibeVoice failed: {result.stderr[-200:]}")
             
-            if not output_path.exists():
+            if not generated.exists():
                 raise RuntimeError("VibeVoice did not produce output file")
             
+            # Same filesystem as the output, so this is a rename rather than a copy
+            os.replace(generated, output_path)
+            
             print(f"✅ Audio saved: {output_path}")
             return output_path
             
         except subprocess.TimeoutExpired:
             raise RuntimeError("VibeVoice timed out")
         finally:
-            temp_txt.unlink(missing_ok=True)
+            shutil.rmtree(work_dir, ignore_errors=True)
     
     def get_audio_duration(self, audio_path: Path) -> float:
-        import wave
+        return audio_duration(audio_path)
+    
+    def get_audio_durations(self, audio_paths: List[Path]) -> dict:
+        return audio_durations(audio_paths)
+
+
+@functools.lru_cache(maxsize=None)
+def _create_service(preferred: str):
+    """Build the TTS service for an engine name; cached so each engine is probed and loaded once"""
+    if preferred == "vibevoice":
+        service = VibeVoiceTTSService()
+        if service.available:
+            return service
+        print("Falling back to Edge-TTS...")
+    
+    if preferred == "edge":
+        service = EdgeTTSService()
+        if service.available:
+            return service
+    
+    # Try VibeVoice first, then Edge
+    for ServiceClass in [VibeVoiceTTSService, EdgeTTSService]:
         try:
-            with wave.open(str(audio_path), 'rb') as wf:
-                return wf.getnframes() / float(wf.getframerate())
+            service = ServiceClass()
+            if service.available:
+                return service
         except:
-            result = subprocess.run(
-                ["ffprobe", "-v", "error", "-show_entries", "format=duration",
-                 "-of", "default=noprint_wrappers=1:nokey=1", str(audio_path)],
-                capture_output=True, text=True
-            )
-            return float(result.stdout.strip())
+            continue
+    
+    raise RuntimeError(
+        "No TTS available. Install edge-tts: pip install edge-tts"
+    )
 
 
 class TTSFactory:
@@ -202,34 +505,16 @@ class TTSFactory:
     @staticmethod
     def create(preferred: str = "vibevoice"):
         """
-        Create TTS service.
+        Create TTS service, shared per engine for the life of the process.
         
         Args:
             preferred: 'vibevoice' (high quality) or 'edge' (simple)
         """
         # Check env variable
         preferred = os.getenv("TTS_ENGINE", preferred).lower()
-        
-        if preferred == "vibevoice":
-            service = VibeVoiceTTSService()
-            if service.available:
-                return service
-            print("Falling back to Edge-TTS...")
-        
-        if preferred == "edge":
-            service = EdgeTTSService()
-            if service.available:
-                return service
-        
-        # Try VibeVoice first, then Edge
-        for ServiceClass in [VibeVoiceTTSService, EdgeTTSService]:
-            try:
-                service = ServiceClass()
-                if service.available:
-                    return service
-            except:
-                continue
-        
-        raise RuntimeError(
-            "No TTS available. Install edge-tts: pip install edge-tts"
-        )
+        return _create_service(preferred)
+    
+    @staticmethod
+    def reset():
+        """Forget cached services so the next create() probes again"""
+        _create_service.cache_clear()
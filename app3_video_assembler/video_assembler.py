@@ -6,16 +6,67 @@ Generates voiceovers with VibeVoice and assembles final YouTube Short.
 
 import json
 import argparse
+import functools
+import hashlib
+import os
 import sys
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional, List
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from shared.config import OUTPUT_DIR, ASSETS_DIR
+from shared.config import OUTPUT_DIR, ASSETS_DIR, FFMPEG_CONCURRENCY, SCENE_DURATION
 from shared.models import Story, AudioAsset, FinalVideo
-from app3_video_assembler.services import TTSFactory, EdgeTTSService, FFmpegService
+from app3_video_assembler.services import TTSFactory, TTSCache, EdgeTTSService, FFmpegService, Segment
+from app3_video_assembler.services.ffmpeg_service import cpu_count
+
+
+@functools.lru_cache(maxsize=1)
+def _default_bgm() -> Optional[Path]:
+    """First bundled music file (cached, assets don't change at runtime)"""
+    bgm_dir = ASSETS_DIR / "bgm"
+    if bgm_dir.exists():
+        for ext in [".mp3", ".wav", ".m4a"]:
+            for bgm_file in bgm_dir.glob(f"*{ext}"):
+                return bgm_file
+    return None
+
+
+def _prefetch(path: Path):
+    """Ask the kernel to start reading a file into the page cache (no-op where unsupported)"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# Last reported quarter per (thread, description); each ffmpeg run reports from its own pool thread
+_progress_marks: dict = {}
+
+
+def _print_progress(description: str, fraction: float):
+    """Print encode progress in 25% steps"""
+    key = (threading.get_ident(), description)
+    last_fraction, last_step = _progress_marks.get(key, (0.0, 0))
+    if fraction < last_fraction:
+        last_step = 0  # A new run with the same description
+    step = int(fraction * 4)
+    if step > last_step:
+        print(f"   ⏳ {description}: {step * 25}%")
+    _progress_marks[key] = (fraction, max(step, last_step))
+    if step >= 4:
+        _progress_marks.pop(key, None)
 
 
 class VideoAssembler:
@@ -29,7 +80,12 @@ class VideoAssembler:
             tts_engine: 'edge' (simple) or 'vibevoice' (advanced)
         """
         self.tts = TTSFactory.create(preferred=tts_engine)
-        self.ffmpeg = FFmpegService()
+        self.tts_cache = TTSCache()
+        # Split the cores between the scene encodes that run side by side
+        self.ffmpeg = FFmpegService(
+            threads=max(1, cpu_count() // FFMPEG_CONCURRENCY),
+            on_progress=_print_progress
+        )
         
         if not self.ffmpeg.available:
             raise RuntimeError("FFmpeg not found. Install FFmpeg to continue.")
@@ -40,7 +96,8 @@ class VideoAssembler:
         visuals_dir: Path,
         output_path: Path,
         add_bgm: bool = True,
-        bgm_path: Optional[Path] = None
+        bgm_path: Optional[Path] = None,
+        fused: bool = False
     ) -> FinalVideo:
         """
         Assemble final video from all components.
@@ -51,6 +108,7 @@ class VideoAssembler:
             output_path: Final output video path
             add_bgm: Whether to add background music
             bgm_path: Custom background music file
+            fused: Render every scene, the concat and the music in one ffmpeg pass
             
         Returns:
             FinalVideo metadata
@@ -64,71 +122,113 @@ class VideoAssembler:
         print(f"\n🎬 Assembling video: '{story.title}'")
         print("=" * 50)
         
-        scene_videos = []
+        bgm = None
+        if add_bgm:
+            bgm = bgm_path or self._get_default_bgm()
+            if not (bgm and bgm.exists()):
+                print("⚠️ No background music file found, skipping")
+                bgm = None
         
+        # Narration lines unchanged since an earlier render come straight from the cache
+        tag = self.tts.cache_tag()
+        cache_keys = {scene.scene_id: TTSCache.key(tag, scene.narration) for scene in story.scenes}
+        narrations = {}
         for scene in story.scenes:
-            print(f"\n📍 Scene {scene.scene_id}")
-            
-            scene_dir = visuals_dir / f"scene_{scene.scene_id:03d}"
-            scene_temp = temp_dir / f"scene_{scene.scene_id:03d}"
-            scene_temp.mkdir(exist_ok=True)
-            
-            # Step 1: Generate audio narration
-            print("   🔊 Generating narration...")
-            audio_path = scene_temp / "narration"  # Extension added by TTS
-            
-            try:
-                audio_path = self.tts.synthesize(scene.narration, audio_path)
-            except Exception as e:
-                print(f"   ⚠️ TTS failed: {e}")
-                continue
-            
-            # Step 2: Get video or create from image
-            video_source = self._get_video_source(scene_dir)
-            
-            if video_source is None:
-                print("   ⚠️ No video found, skipping scene")
-                continue
-            
-            # Step 3: Combine video with audio
-            print("   🔗 Combining video + audio...")
-            scene_video = scene_temp / "scene_with_audio.mp4"
-            
-            self.ffmpeg.add_audio_to_video(
-                video_path=video_source,
-                audio_path=audio_path,
-                output_path=scene_video
+            cached = self.tts_cache.fetch(
+                cache_keys[scene.scene_id], temp_dir / f"scene_{scene.scene_id:03d}" / "narration"
             )
-            
-            scene_videos.append(scene_video)
+            if cached is not None:
+                narrations[scene.scene_id] = cached
+        if narrations:
+            print(f"♻️ Reusing {len(narrations)} cached narrations")
+        
+        # Edge-TTS is network-bound, so fetch every remaining narration concurrently up front
+        if isinstance(self.tts, EdgeTTSService):
+            pending = [scene for scene in story.scenes if scene.scene_id not in narrations]
+            audio_paths = self.tts.synthesize_many(
+                [scene.narration for scene in pending],
+                [temp_dir / f"scene_{scene.scene_id:03d}" / "narration" for scene in pending]
+            ) if pending else []
+            for scene, path in zip(pending, audio_paths):
+                narrations[scene.scene_id] = path
+                if path is not None:
+                    self.tts_cache.store(cache_keys[scene.scene_id], path)
         
-        if not scene_videos:
-            raise RuntimeError("No scene videos to assemble")
+        # Other TTS runs in order on this thread; each scene's ffmpeg work starts as soon as its narration is ready
+        scene_jobs = []
+        segments = []
+        
+        # More encoders than usable cores only time-slice each other (cpu_count honours container affinity)
+        with ThreadPoolExecutor(max_workers=max(1, min(FFMPEG_CONCURRENCY, cpu_count()))) as pool:
+            for scene in story.scenes:
+                print(f"\n📍 Scene {scene.scene_id}")
+                
+                scene_dir = visuals_dir / f"scene_{scene.scene_id:03d}"
+                scene_temp = temp_dir / f"scene_{scene.scene_id:03d}"
+                scene_temp.mkdir(exist_ok=True)
+                
+                # Pull the scene's visuals into the page cache while its narration is synthesized
+                _prefetch(scene_dir / "video_clip.mp4")
+                
+                # Step 1: Generate audio narration
+                if scene.scene_id in narrations:
+                    audio_path = narrations[scene.scene_id]
+                    if audio_path is None:
+                        print("   ⚠️ TTS failed")
+                        continue
+                else:
+                    print("   🔊 Generating narration...")
+                    audio_path = scene_temp / "narration"  # Extension added by TTS
+                    
+                    try:
+                        audio_path = self.tts.synthesize(scene.narration, audio_path)
+                    except Exception as e:
+                        print(f"   ⚠️ TTS failed: {e}")
+                        continue
+                    self.tts_cache.store(cache_keys[scene.scene_id], audio_path)
+                
+                if fused:
+                    segment = self._scene_segment(scene.scene_id, scene_dir, audio_path)
+                    if segment is not None:
+                        segments.append(segment)
+                    continue
+                
+                scene_jobs.append(pool.submit(
+                    self._build_scene_video, scene.scene_id, scene_dir, audio_path, scene_temp,
+                    cache_keys[scene.scene_id]
+                ))
+            
+            scene_videos = [v for v in (job.result() for job in scene_jobs) if v is not None]
         
-        # Step 4: Concatenate all scenes
-        print(f"\n🔗 Concatenating {len(scene_videos)} scenes...")
         combined_path = temp_dir / "combined.mp4"
-        self.ffmpeg.concatenate_videos(scene_videos, combined_path)
         
-        # Step 5: Add background music (optional)
-        if add_bgm:
-            bgm = bgm_path or self._get_default_bgm()
-            if bgm and bgm.exists():
+        if fused:
+            if not segments:
+                raise RuntimeError("No scene videos to assemble")
+            
+            # Steps 2-5 in a single encode
+            print(f"\n🔗 Rendering {len(segments)} scenes in one pass...")
+            self.ffmpeg.assemble_segments(segments, combined_path, music_path=bgm, music_volume=0.12)
+        else:
+            if not scene_videos:
+                raise RuntimeError("No scene videos to assemble")
+            
+            # Steps 4-5: Concatenate all scenes, mixing in background music on the way (optional)
+            print(f"\n🔗 Concatenating {len(scene_videos)} scenes...")
+            if bgm:
                 print("🎵 Adding background music...")
-                final_with_bgm = temp_dir / "final_with_bgm.mp4"
-                self.ffmpeg.add_background_music(
-                    combined_path,
-                    bgm,
-                    final_with_bgm,
-                    music_volume=0.12
-                )
-                combined_path = final_with_bgm
+                self.ffmpeg.concat_with_bgm(scene_videos, bgm, combined_path, music_volume=0.12)
             else:
-                print("⚠️ No background music file found, skipping")
+                self.ffmpeg.concatenate_videos(scene_videos, combined_path)
         
-        # Step 6: Move to final output
+        # Step 6: Move to final output; temp sits next to it, so a hardlink writes no bytes
+        # and the temp copy survives for --keep-temp
         output_path.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy(combined_path, output_path)
+        output_path.unlink(missing_ok=True)
+        try:
+            os.link(combined_path, output_path)
+        except OSError:
+            shutil.copy(combined_path, output_path)
         
         # Get final duration
         duration = self.ffmpeg.get_duration(output_path)
@@ -143,38 +243,95 @@ class VideoAssembler:
             title=story.title
         )
     
-    def _get_video_source(self, scene_dir: Path) -> Optional[Path]:
-        """Get the best available video source for a scene"""
-        # Priority: Wan 2.2 video > Image-based video
+    def _build_scene_video(
+        self,
+        scene_id: int,
+        scene_dir: Path,
+        audio_path: Path,
+        scene_temp: Path,
+        narration_key: str
+    ) -> Optional[Path]:
+        """
+        Produce one scene's clip with its narration muxed in.
         
+        The clip is named after a fingerprint of its inputs, so a rerun into
+        the same temp dir (e.g. after a crash) reuses scenes that are done.
+        
+        Args:
+            scene_id: Scene number (for logging)
+            scene_dir: Scene's visuals directory
+            audio_path: Narration audio file
+            scene_temp: Scratch directory for this scene
+            narration_key: TTS cache key of the narration (engine, voice and text)
+            
+        Returns:
+            Path to the scene video, or None if the scene has no visuals
+        """
+        # Step 2: Prefer the Wan 2.2 clip; just mux the narration onto it
         video_clip = scene_dir / "video_clip.mp4"
-        if video_clip.exists():
-            return video_clip
+        source = video_clip if video_clip.exists() else self._get_scene_image(scene_dir)
+        if source is None:
+            print(f"   ⚠️ Scene {scene_id}: no video found, skipping scene")
+            return None
         
-        # Fall back to image -> video conversion
-        for img_name in ["consistent_image.png", "base_image.png"]:
-            img_path = scene_dir / img_name
-            if img_path.exists():
-                print(f"   🖼️ Converting {img_name} to video...")
-                video_path = scene_dir / "image_video.mp4"
-                self.ffmpeg.image_to_video(
-                    img_path,
-                    video_path,
-                    duration=10,
+        st = source.stat()
+        fingerprint = hashlib.blake2b(
+            f"{narration_key}|{source}|{st.st_mtime_ns}|{st.st_size}|{self.ffmpeg.vcodec}|{SCENE_DURATION}".encode(),
+            digest_size=8
+        ).hexdigest()
+        scene_video = scene_temp / f"scene_{fingerprint}.mp4"
+        if scene_video.exists():
+            print(f"   ♻️ Scene {scene_id}: reusing {scene_video.name}")
+            return scene_video
+        
+        # Render under a temporary name so an interrupted encode is never mistaken for a finished scene
+        partial = scene_temp / f"scene_{fingerprint}.partial.mp4"
+        try:
+            if source == video_clip:
+                print(f"   🔗 Scene {scene_id}: combining video + audio...")
+                self.ffmpeg.add_audio_to_video(
+                    video_path=video_clip,
+                    audio_path=audio_path,
+                    output_path=partial
+                )
+            else:
+                # Step 3: Otherwise render the still image and narration in one pass
+                print(f"   🖼️ Scene {scene_id}: rendering {source.name} with narration...")
+                self.ffmpeg.build_segment(
+                    source,
+                    audio_path,
+                    partial,
+                    max_duration=SCENE_DURATION,
                     zoom_effect=True
                 )
-                return video_path
+            os.replace(partial, scene_video)
+        finally:
+            partial.unlink(missing_ok=True)
+        return scene_video
+    
+    def _scene_segment(self, scene_id: int, scene_dir: Path, audio_path: Path) -> Optional[Segment]:
+        """Describe a scene for the fused render: Wan clip if present, else its still image"""
+        video_clip = scene_dir / "video_clip.mp4"
+        if video_clip.exists():
+            return Segment(audio=audio_path, video=video_clip)
         
+        image_path = self._get_scene_image(scene_dir)
+        if image_path is None:
+            print(f"   ⚠️ Scene {scene_id}: no video found, skipping scene")
+            return None
+        return Segment(audio=audio_path, image=image_path, max_duration=SCENE_DURATION)
+    
+    def _get_scene_image(self, scene_dir: Path) -> Optional[Path]:
+        """Get the best available still image for a scene"""
+        for img_name in ["consistent_image.jpg", "consistent_image.png", "base_image.jpg", "base_image.png"]:
+            img_path = scene_dir / img_name
+            if img_path.exists():
+                return img_path
         return None
     
     def _get_default_bgm(self) -> Optional[Path]:
         """Get default background music if available"""
-        bgm_dir = ASSETS_DIR / "bgm"
-        if bgm_dir.exists():
-            for ext in [".mp3", ".wav", ".m4a"]:
-                for bgm_file in bgm_dir.glob(f"*{ext}"):
-                    return bgm_file
-        return None
+        return _default_bgm()
     
     def cleanup_temp(self, output_path: Path):
         """Remove temporary files"""
@@ -193,6 +350,7 @@ def main():
     parser.add_argument("--no-bgm", action="store_true", help="Skip background music")
     parser.add_argument("--bgm", type=str, help="Custom background music file")
     parser.add_argument("--keep-temp", action="store_true", help="Keep temporary files")
+    parser.add_argument("--fused", action="store_true", help="Render all scenes, concat and music in one ffmpeg pass")
     
     args = parser.parse_args()
     
@@ -201,7 +359,7 @@ def main():
         print(f"❌ Story file not found: {story_path}")
         sys.exit(1)
     
-    story = Story.model_validate_json(story_path.read_text())
+    story = Story.model_validate_json(story_path.read_bytes())
     print(f"📖 Loaded story: '{story.title}'")
     
     visuals_dir = Path(args.visuals)
@@ -223,7 +381,8 @@ def main():
             visuals_dir=visuals_dir,
             output_path=output_path,
             add_bgm=not args.no_bgm,
-            bgm_path=Path(args.bgm) if args.bgm else None
+            bgm_path=Path(args.bgm) if args.bgm else None,
+            fused=args.fused
         )
         
         if not args.keep_temp:
@@ -1,9 +1,6 @@
 # Shared Configuration - Local Offline Models
 import os
 from pathlib import Path
-from dotenv import load_dotenv
-
-load_dotenv()
 
 # Paths
 PROJECT_ROOT = Path(__file__).parent.parent
@@ -11,6 +8,13 @@ OUTPUT_DIR = PROJECT_ROOT / "output"
 ASSETS_DIR = PROJECT_ROOT / "app3_video_assembler" / "assets"
 MODELS_DIR = PROJECT_ROOT / "models"  # Local model storage
 
+# Explicit path: skips find_dotenv's stack inspection and directory walk on every import.
+# Deployments that set the environment directly don't pay for importing dotenv at all.
+_ENV_FILE = PROJECT_ROOT / ".env"
+if _ENV_FILE.is_file():
+    from dotenv import load_dotenv
+    load_dotenv(_ENV_FILE)
+
 # Ensure directories exist
 OUTPUT_DIR.mkdir(exist_ok=True)
 MODELS_DIR.mkdir(exist_ok=True)
@@ -20,12 +24,15 @@ MODELS_DIR.mkdir(exist_ok=True)
 # ===========================================
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "gemma3:27b-abliterated")
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+OLLAMA_MAX_INFLIGHT = int(os.getenv("OLLAMA_MAX_INFLIGHT", "2"))  # Concurrent requests per process
 
 # ===========================================
 # Z-Image Config (Local Diffusers)
 # ===========================================
 ZIMAGE_MODEL = os.getenv("ZIMAGE_MODEL", "Tongyi-MAI/Z-Image-Turbo")
 ZIMAGE_DEVICE = os.getenv("ZIMAGE_DEVICE", "cuda")
+ZIMAGE_QUANT = os.getenv("ZIMAGE_QUANT", "none").lower()  # Transformer weights: fp8, int8, or none
+ZIMAGE_COMPILE = os.getenv("ZIMAGE_COMPILE", "true").lower() == "true"  # torch.compile the transformer (CUDA only)
 
 # ===========================================
 # Wan 2.2 Config (Local Video Generation)
@@ -39,6 +46,8 @@ WAN_OFFLOAD_MODEL = os.getenv("WAN_OFFLOAD_MODEL", "true").lower() == "true"
 # Qwen-Image-Edit Config (Local)
 # ===========================================
 QWEN_IMAGE_EDIT_MODEL = os.getenv("QWEN_IMAGE_EDIT_MODEL", "Qwen/Qwen-Image-Edit")
+QWEN_QUANT = os.getenv("QWEN_QUANT", "nf4").lower()  # nf4, int8, or none (full precision, 48GB+)
+QWEN_EDIT_BATCH_SIZE = int(os.getenv("QWEN_EDIT_BATCH_SIZE", "4"))  # Scenes per edit forward pass
 
 # ===========================================
 # VibeVoice TTS Config (Local)
@@ -46,6 +55,9 @@ QWEN_IMAGE_EDIT_MODEL = os.getenv("QWEN_IMAGE_EDIT_MODEL", "Qwen/Qwen-Image-Edit
 VIBEVOICE_MODEL = os.getenv("VIBEVOICE_MODEL", "microsoft/VibeVoice-Realtime-0.5B")
 VIBEVOICE_SPEAKER = os.getenv("VIBEVOICE_SPEAKER", "Carter")
 VIBEVOICE_REPO_PATH = os.getenv("VIBEVOICE_REPO_PATH", str(MODELS_DIR / "VibeVoice"))
+VIBEVOICE_DDPM_STEPS = int(os.getenv("VIBEVOICE_DDPM_STEPS", "5"))  # Diffusion steps per speech latent
+VIBEVOICE_QUANT = os.getenv("VIBEVOICE_QUANT", "none").lower()  # int8 (LM weights via bitsandbytes) or none
+VIBEVOICE_COMPILE = os.getenv("VIBEVOICE_COMPILE", "false").lower() == "true"  # torch.compile the diffusion head (CUDA only)
 
 # ===========================================
 # Video Settings
@@ -56,13 +68,24 @@ VIDEO_FPS = 24
 TARGET_DURATION = 60  # seconds
 SCENES_COUNT = 6
 SCENE_DURATION = TARGET_DURATION // SCENES_COUNT  # ~10 seconds each
+VIDEO_ENCODER = os.getenv("VIDEO_ENCODER", "auto").lower()  # auto (first usable GPU encoder), nvenc, qsv, videotoolbox, amf, or libx264
+FFMPEG_CONCURRENCY = max(1, int(os.getenv("FFMPEG_CONCURRENCY", "4")))  # ffmpeg processes running at once, per process (min 1)
+
+# Narration clips reused across runs, keyed by engine settings + text
+TTS_CACHE_DIR = Path(os.getenv("TTS_CACHE_DIR", str(OUTPUT_DIR / "tts_cache")))
+TTS_CACHE_MB = int(os.getenv("TTS_CACHE_MB", "500"))  # Size cap, least recently used clips evicted first (0 disables)
 
 # Wan 2.2 video settings
 WAN_VIDEO_SIZE = "704*1280"  # Vertical (ti2v-5B supports 704*1280 or 1280*704)
 WAN_VIDEO_FRAMES = 121  # ~5 seconds at 24fps
 
+# Scene images passed between pipeline stages: jpeg (q95, fast) or png (lossless)
+INTERMEDIATE_FORMAT = os.getenv("INTERMEDIATE_FORMAT", "jpeg").lower()
+
 # ===========================================
 # Hardware Settings
 # ===========================================
 TORCH_DTYPE = "bfloat16"  # or "float16"
 LOW_VRAM_MODE = os.getenv("LOW_VRAM_MODE", "true").lower() == "true"
+# Z-Image CPU offload: sequential (per layer, lowest VRAM), model (per component), or none
+ZIMAGE_OFFLOAD = os.getenv("ZIMAGE_OFFLOAD", "sequential" if LOW_VRAM_MODE else "none").lower()
@@ -0,0 +1,16 @@
+# Shared HTTP session for local services (Ollama)
+import functools
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+@functools.lru_cache(maxsize=None)
+def get_session() -> requests.Session:
+    """Process-wide keep-alive session; one connection pool per host"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip, deflate"})
+    return session
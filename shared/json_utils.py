@@ -0,0 +1,56 @@
+# JSON helpers shared across the pipeline
+import json
+import os
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:  # Optional speedup, fall back to stdlib json
+    orjson = None
+
+
+def loads(data):
+    """Parse JSON from str or bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj) -> bytes:
+    """Serialize to compact UTF-8 JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def write_json_atomic(path: Path, obj) -> Path:
+    """
+    Write obj as indented JSON, replacing path atomically.
+
+    The data goes to a sibling .tmp file first so a crash mid-write
+    never leaves a truncated file behind.
+    """
+    if orjson is not None:
+        raw = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    else:
+        raw = json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+    path = Path(path)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_bytes(raw)
+    os.replace(tmp, path)
+    return path
+
+
+def parse_llm_json(raw: str):
+    """
+    Parse the JSON object embedded in an LLM response.
+
+    Models often wrap the object in markdown code fences or add a short
+    preamble, so everything outside the outermost braces is ignored.
+    Raises ValueError if no valid object is found.
+    """
+    start = raw.find("{")
+    end = raw.rfind("}")
+    if start == -1 or end < start:
+        raise ValueError("No JSON object found in response")
+    return loads(raw[start:end + 1])